@@ -0,0 +1,12 @@
+# src/__init__.py
+#
+# Модули src/ импортируют друг друга напрямую (from chunkstore import …), как при
+# запуске python src/telegram_bot.py. Чтобы работали и python -m src.indexer и т.п.,
+# каталог пакета добавляется в sys.path при импорте src.
+
+import os
+import sys
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
@@ -0,0 +1,94 @@
+# src/answer_cache.py
+
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+import numpy as np
+
+logger = logging.getLogger("answer_cache")
+
+def normalize_question(q: str) -> str:
+    """
+    Нормализация для точного совпадения: регистр, пробелы, финальная пунктуация.
+    """
+    q = re.sub(r"\s+", " ", q.lower()).strip()
+    return q.rstrip("?!.… ")
+
+class AnswerCache:
+    """
+    Кэш ответов перед RAG-пайплайном.
+    1) точное совпадение нормализованного вопроса,
+    2) семантическое: косинус эмбеддингов вопросов >= threshold.
+    Ключи раздельные для каждой модели Ollama. Вытеснение LRU + TTL.
+    Кэш целиком сбрасывается, когда меняется версия индекса (index_version()).
+    """
+
+    def __init__(self, index_version: Callable[[], object], max_size: int = 1000,
+                 ttl: float = 86400, threshold: float = 0.95):
+        self.index_version = index_version
+        self.max_size   = max_size
+        self.ttl        = ttl
+        self.threshold  = threshold
+        # (model, norm_question) -> (answer, qv, ts)
+        self._entries: OrderedDict[tuple[str, str], tuple[str, np.ndarray, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = index_version()
+
+    def _check_index(self) -> None:
+        version = self.index_version()
+        if version != self._version:
+            logger.info(f"Index changed, dropping {len(self._entries)} cached answers")
+            self._entries.clear()
+            self._version = version
+
+    def _evict_expired(self, now: float) -> None:
+        expired = [k for k, (_, _, ts) in self._entries.items() if now - ts > self.ttl]
+        for k in expired:
+            del self._entries[k]
+
+    def get_exact(self, model: str, question: str) -> str | None:
+        key = (model, normalize_question(question))
+        with self._lock:
+            self._check_index()
+            self._evict_expired(time.time())
+            hit = self._entries.get(key)
+            if hit is None:
+                return None
+            self._entries.move_to_end(key)
+            return hit[0]
+
+    def get_similar(self, model: str, question: str, qv: np.ndarray) -> str | None:
+        with self._lock:
+            # ответы на запросы без эмбеддинга (лексический fast path) — только точные
+            keys = [k for k in self._entries if k[0] == model and self._entries[k][1] is not None]
+            if not keys:
+                return None
+            # эмбеддинги нормализованы → косинус = скалярное произведение
+            mat  = np.stack([self._entries[k][1] for k in keys])
+            sims = mat @ qv.reshape(-1)
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            k = keys[best]
+            self._entries.move_to_end(k)
+            logger.info(f"Semantic cache hit ({sims[best]:.3f}): {question!r} ~ {k[1]!r}")
+            return self._entries[k][0]
+
+    def put(self, model: str, question: str, qv: np.ndarray | None, answer: str) -> None:
+        if not answer:
+            return
+        key = (model, normalize_question(question))
+        vec = qv.reshape(-1).astype("float32") if qv is not None else None
+        with self._lock:
+            self._entries[key] = (answer, vec, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
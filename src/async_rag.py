@@ -0,0 +1,107 @@
+# src/async_rag.py
+
+import os
+import asyncio
+import logging
+import yaml
+from typing import AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
+
+from rag_engine import (
+    cache_lookup, cache_store, prepare_prompt, log_interaction, record_llm, interactions,
+    NOT_SURE, SYSTEM_PROMPT, search,
+)
+from metrics    import REQUESTS, STAGE_SECONDS
+from model      import stream_answer, close_session
+
+def load_config():
+    src  = os.path.dirname(os.path.abspath(__file__))
+    root = os.path.dirname(src)
+    with open(os.path.join(root, "config.yaml"), encoding="utf-8") as f:
+        return yaml.safe_load(f)
+
+logger = logging.getLogger("async_rag")
+
+cfg = load_config()
+CONC = cfg.get("concurrency", {})
+
+CPU_WORKERS = CONC.get("cpu_workers", 2)
+
+# CPU-стадии (эмбеддинг, FAISS, rerank) — torch/faiss отпускают GIL,
+# поэтому пул потоков действительно работает параллельно.
+CPU_POOL = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="rag-cpu")
+
+async def acache_lookup(question: str, trace: dict | None = None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(CPU_POOL, cache_lookup, question, trace)
+
+async def aprepare_prompt(question: str, qv=None, trace: dict | None = None) -> str | None:
+    """
+    Retrieval + сборка промта в CPU-пуле, не блокируя event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(CPU_POOL, prepare_prompt, question, qv, trace)
+
+async def ainit() -> None:
+    """
+    Загрузить индекс и модели (или проверить retrieval-сервис) до первого вопроса.
+    """
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, search.init)
+
+def start_watcher() -> None:
+    search.start_watcher()
+
+async def areload_index(force: bool = True) -> bool:
+    """
+    Перечитать индекс в фоне; запросы продолжают работать на старой версии до подмены.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, search.reload_index, force)
+
+async def answer_question_async(question: str) -> str:
+    """
+    Асинхронный аналог rag_engine.answer_question для aiogram-хендлеров.
+    """
+    parts = [part async for part in answer_question_stream(question)]
+    return "".join(parts).strip()
+
+async def answer_question_stream(question: str) -> AsyncIterator[str]:
+    """
+    То же, что answer_question_async, но отдаёт токены по мере генерации.
+    """
+    trace: dict = {}
+    cached, qv = await acache_lookup(question, trace)
+    if cached is not None:
+        REQUESTS.inc("cache")
+        yield cached
+        log_interaction(question, cached, trace)
+        return
+
+    prompt = await aprepare_prompt(question, qv, trace)
+    if prompt is None:
+        REQUESTS.inc("not_found")
+        yield NOT_SURE
+        return
+
+    parts = []
+    stats: dict = {}
+    # не timed(): контекстный менеджер через yield засчитал бы в llm и ожидание
+    # потребителя (правки сообщения в Telegram) — берём время со стороны Ollama
+    async for part in stream_answer(prompt, SYSTEM_PROMPT, stats):
+        parts.append(part)
+        yield part
+    llm_s = stats["total_duration"] / 1e9 if stats.get("total_duration") else stats["duration"]
+    STAGE_SECONDS.observe(llm_s, "llm")
+    trace["llm"] = round(llm_s, 4)
+    record_llm(trace, stats)
+
+    answer = "".join(parts).strip()
+    cache_store(question, qv, answer)
+    REQUESTS.inc("answered")
+    log_interaction(question, answer, trace)
+
+async def shutdown() -> None:
+    CPU_POOL.shutdown(wait=False, cancel_futures=True)
+    await close_session()
+    await asyncio.to_thread(interactions.close)
@@ -0,0 +1,136 @@
+# src/balancer.py
+
+import time
+import random
+import asyncio
+import threading
+import logging
+
+import aiohttp
+
+logger = logging.getLogger("balancer")
+
+class Backend:
+    """
+    Один сервер Ollama: сколько запросов на нём сейчас, скорость генерации
+    (EWMA токенов/с), какие модели загружены и здоров ли он.
+    """
+
+    def __init__(self, url: str):
+        self.url      = url.rstrip("/")
+        self.inflight = 0
+        self.tps      = 0.0
+        self.models: dict[str, dict] = {}   # имя → запись из /api/ps
+        self.healthy  = True
+        self.fails    = 0
+        self.retry_at = 0.0
+        # inflight меняют и event loop (stream_answer), и рабочие потоки
+        # (синхронный generate_answer через asyncio.to_thread)
+        self._lock    = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            self.inflight += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self.inflight -= 1
+
+    def has_model(self, name: str) -> bool:
+        return any(m == name or m.startswith(name + ":") for m in self.models)
+
+class Balancer:
+    """
+    Маршрутизация запросов между несколькими Ollama:
+    здоровый → с уже загруженной моделью → меньше in-flight → быстрее по токенам/с.
+    После fail_threshold ошибок подряд бэкенд выводится из ротации и
+    перепроверяется через /api/ps с экспоненциальной паузой.
+    """
+
+    def __init__(self, urls: list[str], fail_threshold: int = 2,
+                 cooldown: float = 5.0, max_cooldown: float = 60.0, probe_interval: float = 10.0):
+        if not urls:
+            raise ValueError("No Ollama backends configured")
+        self.backends = [Backend(u) for u in urls]
+        self.fail_threshold = fail_threshold
+        self.cooldown       = cooldown
+        self.max_cooldown   = max_cooldown
+        self.probe_interval = probe_interval
+        self._prober: asyncio.Task | None = None
+
+    def pick(self, model: str, exclude: set[str] = frozenset()) -> Backend:
+        pool = [b for b in self.backends if b.url not in exclude] or self.backends
+        healthy = [b for b in pool if b.healthy]
+        if not healthy:
+            # все лежат — пробуем тот, что должен подняться раньше остальных
+            return min(pool, key=lambda b: b.retry_at)
+        # random — чтобы при равной нагрузке не бить всегда в первый
+        return min(healthy, key=lambda b: (not b.has_model(model), b.inflight, -b.tps, random.random()))
+
+    def mark_ok(self, b: Backend, model: str | None = None,
+                tokens: int = 0, seconds: float = 0.0) -> None:
+        if not b.healthy:
+            logger.info(f"Backend {b.url} is back")
+        b.healthy, b.fails = True, 0
+        if model:
+            b.models.setdefault(model, {})
+        if tokens and seconds > 0:
+            rate = tokens / seconds
+            b.tps = rate if b.tps == 0 else 0.8 * b.tps + 0.2 * rate
+
+    def mark_failed(self, b: Backend, err: Exception | None = None) -> None:
+        b.fails += 1
+        if b.fails >= self.fail_threshold:
+            pause = min(self.cooldown * 2 ** (b.fails - self.fail_threshold), self.max_cooldown)
+            if b.healthy:
+                logger.warning(f"Backend {b.url} marked unhealthy: {err!r}")
+            b.healthy, b.retry_at = False, time.monotonic() + pause
+
+    async def probe(self, session: aiohttp.ClientSession, b: Backend) -> bool:
+        """
+        /api/ps: жив ли сервер и какие модели у него сейчас в памяти.
+        Сборки Ollama без /api/ps отвечают 404 — тогда живость проверяется
+        через /api/tags, а список загруженных моделей остаётся прежним.
+        """
+        timeout = aiohttp.ClientTimeout(total=3)
+        try:
+            async with session.get(f"{b.url}/api/ps", timeout=timeout) as resp:
+                if resp.status == 404:
+                    data = None
+                else:
+                    resp.raise_for_status()
+                    data = await resp.json()
+            if data is None:
+                async with session.get(f"{b.url}/api/tags", timeout=timeout) as resp:
+                    resp.raise_for_status()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.mark_failed(b, e)
+            return False
+        if data is not None:
+            b.models = {m.get("name", ""): m for m in data.get("models", [])}
+        self.mark_ok(b)
+        return True
+
+    async def probe_all(self, session: aiohttp.ClientSession) -> None:
+        await asyncio.gather(*(self.probe(session, b) for b in self.backends))
+
+    async def _probe_loop(self, session_factory) -> None:
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            now = time.monotonic()
+            # здоровые — ради списка моделей, лежащие — когда истекла пауза
+            due = [b for b in self.backends if b.healthy or b.retry_at <= now]
+            await asyncio.gather(*(self.probe(session_factory(), b) for b in due))
+
+    def start(self, session_factory) -> None:
+        if self._prober is None or self._prober.done():
+            self._prober = asyncio.create_task(self._probe_loop(session_factory))
+
+    async def stop(self) -> None:
+        if self._prober is not None:
+            self._prober.cancel()
+            try:
+                await self._prober
+            except asyncio.CancelledError:
+                pass
+        self._prober = None
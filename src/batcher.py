@@ -0,0 +1,78 @@
+# src/batcher.py
+
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable
+
+logger = logging.getLogger("batcher")
+
+class MicroBatcher:
+    """
+    Собирает одновременные вызовы из разных потоков в один батч:
+    ждёт до max_wait_ms или до max_batch элементов, затем вызывает fn(items)
+    одним вызовом. fn должна вернуть список результатов той же длины.
+    Одинаковые ключи, которые уже в обработке, получают общий Future.
+    """
+
+    def __init__(self, fn: Callable[[list], list], max_batch: int = 16,
+                 max_wait_ms: float = 5, name: str = "batcher"):
+        self.fn        = fn
+        self.max_batch = max_batch
+        self.max_wait  = max_wait_ms / 1000
+        self.name      = name
+        self._q: queue.Queue = queue.Queue()
+        self._inflight: dict[Hashable, Future] = {}
+        self._lock   = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+            self._thread.start()
+
+    def submit(self, key: Hashable, item: Any) -> Future:
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                return fut
+            fut = Future()
+            self._inflight[key] = fut
+            self._ensure_thread()
+        self._q.put((key, item, fut))
+        return fut
+
+    def __call__(self, key: Hashable, item: Any) -> Any:
+        return self.submit(key, item).result()
+
+    def _collect(self) -> list[tuple]:
+        batch    = [self._q.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            rest = deadline - time.monotonic()
+            if rest <= 0:
+                break
+            try:
+                batch.append(self._q.get(timeout=rest))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._collect()
+            try:
+                results = self.fn([item for _, item, _ in batch])
+                for (_, _, fut), res in zip(batch, results):
+                    fut.set_result(res)
+            except Exception as e:
+                logger.exception(f"[{self.name}] batch of {len(batch)} failed")
+                for _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+            finally:
+                with self._lock:
+                    for key, _, _ in batch:
+                        self._inflight.pop(key, None)
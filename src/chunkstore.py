@@ -0,0 +1,144 @@
+# src/chunkstore.py
+
+import os
+import json
+import mmap
+from urllib.parse import urlparse
+
+import numpy as np
+
+from lang import norm_lang
+
+# Колоночное хранилище метаданных чанков (замена metadata.pkl):
+#   ids.npy           int64   — стабильные ID чанков, отсортированы
+#   text_offsets.npy  int64   — границы текстов в texts.bin (n + 1)
+#   texts.bin                 — все тексты подряд в UTF-8
+#   page.npy          int32   — номер страницы в pages.json
+#   chunk_id.npy, start_token.npy, end_token.npy  int32
+#   text_hash.npy     S64     — sha256 текста (для инкрементального индексатора)
+#   pages.json                — [[page_url, page_title, page_lang], …]
+#   sources.json              — {uid: [url, …]} для чанков, свёрнутых из
+#                               почти-дубликатов с нескольких страниц (src/dedup.py)
+# Всё открывается через mmap: старт не зависит от размера корпуса,
+# а несколько процессов бота делят страницы через кэш ОС.
+
+INT_FIELDS = ("chunk_id", "start_token", "end_token")
+
+def write_store(path: str, meta: dict[int, dict]) -> None:
+    """
+    meta: {uid: {"page_url", "page_title", "page_lang", "chunk_id",
+                 "start_token", "end_token", "text", "text_hash", ["sources"]}}
+    """
+    os.makedirs(path, exist_ok=True)
+    uids = np.array(sorted(meta), dtype="int64")
+
+    pages: dict[tuple, int] = {}
+    page_col = np.empty(len(uids), dtype="int32")
+    ints     = {k: np.empty(len(uids), dtype="int32") for k in INT_FIELDS}
+    hashes   = np.empty(len(uids), dtype="S64")
+    offsets  = np.zeros(len(uids) + 1, dtype="int64")
+
+    with open(os.path.join(path, "texts.bin"), "wb") as f:
+        for i, uid in enumerate(uids):
+            m   = meta[int(uid)]
+            key = (m["page_url"], m.get("page_title", ""), m.get("page_lang", ""))
+            page_col[i] = pages.setdefault(key, len(pages))
+            for k in INT_FIELDS:
+                ints[k][i] = m.get(k, -1)
+            hashes[i] = m.get("text_hash", "").encode("ascii")
+            data = m["text"].encode("utf-8")
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+
+    np.save(os.path.join(path, "ids.npy"), uids)
+    np.save(os.path.join(path, "text_offsets.npy"), offsets)
+    np.save(os.path.join(path, "page.npy"), page_col)
+    np.save(os.path.join(path, "text_hash.npy"), hashes)
+    for k, arr in ints.items():
+        np.save(os.path.join(path, f"{k}.npy"), arr)
+    with open(os.path.join(path, "pages.json"), "w", encoding="utf-8") as f:
+        json.dump([list(p) for p in pages], f, ensure_ascii=False)
+    with open(os.path.join(path, "sources.json"), "w", encoding="utf-8") as f:
+        json.dump({str(uid): m["sources"] for uid, m in meta.items() if m.get("sources")}, f, ensure_ascii=False)
+
+class ChunkStore:
+    """
+    Read-only доступ к хранилищу: store[uid] → dict, как раньше metadata[idx].
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        self.ids      = load("ids.npy")
+        self.offsets  = load("text_offsets.npy")
+        self.page     = load("page.npy")
+        self.hashes   = load("text_hash.npy")
+        self.ints     = {k: load(f"{k}.npy") for k in INT_FIELDS}
+        with open(os.path.join(path, "pages.json"), encoding="utf-8") as f:
+            self.pages = [tuple(p) for p in json.load(f)]
+        # снимки до дедупликации без sources.json — у каждого чанка один источник
+        src_path = os.path.join(path, "sources.json")
+        self.sources: dict[int, list[str]] = {}
+        if os.path.exists(src_path):
+            with open(src_path, encoding="utf-8") as f:
+                self.sources = {int(k): v for k, v in json.load(f).items()}
+
+        with open(os.path.join(path, "texts.bin"), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            # mmap нулевой длины недопустим
+            self._texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def row(self, uid: int) -> int:
+        i = int(np.searchsorted(self.ids, uid))
+        if i >= len(self.ids) or self.ids[i] != uid:
+            raise KeyError(uid)
+        return i
+
+    def text(self, i: int) -> str:
+        return self._texts[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def page_of(self, i: int) -> tuple[str, str, str]:
+        return self.pages[self.page[i]]
+
+    def get_row(self, i: int) -> dict:
+        url, title, lang = self.page_of(i)
+        return {
+            "page_url":   url,
+            "page_title": title,
+            "page_lang":  lang,
+            **{k: int(v[i]) for k, v in self.ints.items()},
+            "text":       self.text(i),
+            "sources":    self.sources.get(int(self.ids[i]), [url]),
+        }
+
+    def __getitem__(self, uid: int) -> dict:
+        return self.get_row(self.row(uid))
+
+    def summary(self) -> dict[int, dict]:
+        """
+        {uid: {"page_url", "page_lang", "text_hash"}} без чтения текстов — для индексатора.
+        """
+        return {
+            int(uid): {"page_url": self.pages[p][0], "page_lang": self.pages[p][2], "text_hash": h.decode("ascii")}
+            for uid, p, h in zip(self.ids, self.page, self.hashes)
+        }
+
+    def select(self, url_prefix: str | None = None, lang: str | None = None) -> np.ndarray:
+        """
+        ID чанков страниц, URL (или путь URL) которых начинается с url_prefix.
+        Свёрнутый дубликат подходит, если подходит любой из его источников.
+        lang — только страницы этого языка (norm_lang, как у языковых шардов).
+        """
+        match = lambda url: (url_prefix is None or url.startswith(url_prefix)
+                             or urlparse(url).path.startswith(url_prefix))
+        in_lang = lambda page_lang: lang is None or norm_lang(page_lang) == lang
+        pages = [i for i, (url, _, page_lang) in enumerate(self.pages) if match(url) and in_lang(page_lang)]
+        ids = np.asarray(self.ids[np.isin(self.page, pages)], dtype="int64")
+        if url_prefix is None:
+            return ids
+        extra = [uid for uid, urls in self.sources.items()
+                 if any(map(match, urls)) and in_lang(self.page_of(self.row(uid))[2])]
+        return np.union1d(ids, np.array(extra, dtype="int64")) if extra else ids
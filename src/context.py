@@ -0,0 +1,125 @@
+# src/context.py
+
+import re
+import logging
+
+logger = logging.getLogger("context")
+
+SHINGLE = 4          # слов в шингле для поиска почти-дубликатов
+MIN_OVERLAP = 16     # символов: меньшее совпадение краёв не считаем перекрытием
+
+def n_tokens(chunk: dict) -> int:
+    # длина по разметке чанкера (токенизатор эмбеддера) — без повторной токенизации
+    return max(chunk.get("end_token", 0) - chunk.get("start_token", 0), 0)
+
+def shingles(text: str) -> set[int]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE:
+        return {hash(" ".join(words))} if words else set()
+    return {hash(" ".join(words[i:i + SHINGLE])) for i in range(len(words) - SHINGLE + 1)}
+
+def merge_text(a: str, b: str) -> str:
+    """
+    Склейка соседних чанков одной страницы: хвост a совпадает с началом b
+    (перекрытие chunk_overlap токенов), поэтому общий кусок берём один раз.
+    """
+    head = b[:MIN_OVERLAP]
+    pos = a.find(head) if len(head) == MIN_OVERLAP else -1
+    while pos != -1:
+        if b.startswith(a[pos:]):
+            return a[:pos] + b
+        pos = a.find(head, pos + 1)
+    return a.rstrip() + " " + b.lstrip()
+
+def merge_spans(chunks: list[dict]) -> list[dict]:
+    """
+    Объединяет пересекающиеся/смежные чанки одной страницы по start_token/end_token.
+    Порядок результата — по лучшему рангу входящих в span чанков.
+    """
+    by_page: dict[str, list[tuple[int, dict]]] = {}
+    for rank, c in enumerate(chunks):
+        by_page.setdefault(c.get("page_url", ""), []).append((rank, c))
+
+    spans = []
+    for url, items in by_page.items():
+        items.sort(key=lambda x: x[1].get("start_token", 0))
+        cur = None
+        for rank, c in items:
+            if cur is not None and c.get("start_token", 0) <= cur["end_token"]:
+                if c.get("end_token", 0) > cur["end_token"]:
+                    text = c.get("text", "")
+                    cur["text"] = merge_text(cur["text"], text)
+                    cur["end_token"] = c["end_token"]
+                    # merge_text оставляет b целиком в конце (или b.lstrip())
+                    tail = text if cur["text"].endswith(text) else text.lstrip()
+                    cur["pieces"].append((c.get("start_token", 0), c["end_token"],
+                                          len(cur["text"]) - len(tail), len(cur["text"]), rank))
+                cur["rank"]  = min(cur["rank"], rank)
+                cur["score"] = max(cur["score"], c.get("score", 0.0))
+                if c.get("sources"):
+                    cur["sources"] = list(dict.fromkeys(cur.get("sources", [url]) + c["sources"]))
+                continue
+            cur = {**c, "rank": rank, "score": c.get("score", 0.0), "text": c.get("text", "")}
+            # границы входящих чанков: (start_token, end_token, начало и конец в text, ранг)
+            cur["pieces"] = [(c.get("start_token", 0), c.get("end_token", 0), 0, len(cur["text"]), rank)]
+            spans.append(cur)
+    spans.sort(key=lambda s: s["rank"])
+    return spans
+
+def fit_span(span: dict, budget: int) -> dict:
+    """
+    Урезает span до budget токенов по границам чанков: от лучшего по рангу
+    чанка расширяется к соседям (сначала к более релевантному), пока влезает.
+    Если и один чанк больше budget — обрезается его текст.
+    """
+    pieces = span["pieces"]
+    i = j = min(range(len(pieces)), key=lambda n: pieces[n][4])
+    while True:
+        grow = [n for n in (i - 1, j + 1)
+                if 0 <= n < len(pieces) and max(pieces[j][1], pieces[n][1]) - min(pieces[i][0], pieces[n][0]) <= budget]
+        if not grow:
+            break
+        n = min(grow, key=lambda n: pieces[n][4])
+        i, j = min(i, n), max(j, n)
+    start, end = pieces[i][0], pieces[j][1]
+    text = span["text"][pieces[i][2]:pieces[j][3]]
+    if end - start > budget:
+        text = text[:len(text) * budget // max(end - start, 1)]
+        end = start + budget
+    return {**span, "text": text, "start_token": start, "end_token": end}
+
+def build_context(chunks: list[dict], budget: int, dedup_threshold: float = 0.8) -> list[dict]:
+    """
+    Собирает контекст для промта:
+    1) склеивает соседние чанки одной страницы,
+    2) выкидывает почти-дубликаты (повторяющийся текст сайта: меню, футеры) —
+       доля общих шинглов с уже выбранным фрагментом >= dedup_threshold,
+    3) набирает фрагменты в порядке релевантности, пока влезают в budget токенов;
+       первый (самый релевантный) при переполнении урезается, а не пропускается.
+    """
+    before = sum(n_tokens(c) for c in chunks)
+    taken, seen, used = [], [], 0
+    dropped = 0
+    for span in merge_spans(chunks):
+        sh = shingles(span["text"])
+        if sh and any(len(sh & s) / len(sh) >= dedup_threshold for s in seen):
+            dropped += 1
+            continue
+        size = n_tokens(span)
+        if used + size > budget:
+            if taken:
+                continue  # следующий фрагмент может быть короче
+            # самый релевантный фрагмент не выкидываем — урезаем до бюджета
+            span = fit_span(span, budget)
+            size = n_tokens(span)
+        taken.append(span)
+        seen.append(sh)
+        used += size
+
+    logger.info(
+        f"Context: {len(chunks)} chunks → {len(taken)} passages, "
+        f"{used}/{before} tokens ({before - used} saved, {dropped} duplicates)"
+    )
+    for span in taken:
+        span.pop("pieces", None)
+    return taken
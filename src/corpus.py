@@ -0,0 +1,135 @@
+# src/corpus.py
+
+import os
+import io
+import json
+import time
+from typing import Iterator
+
+# Корпус страниц и чанков в виде шардов JSONL (опционально zstd):
+#   <dir>/manifest.json                 — текущее поколение и список шардов
+#   <dir>/<gen>-pages-00000.jsonl[.zst] — страницы (без чанков)
+#   <dir>/<gen>-chunks-00000.jsonl[.zst] — чанки с page_url / page_title / page_lang
+# Каждый прогон ingest пишет новое поколение и атомарно подменяет manifest.json.
+
+KINDS = ("pages", "chunks")
+
+def _open(path: str, mode: str, compression: str):
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("corpus.compression=zstd requires the 'zstandard' package") from e
+        if mode == "w":
+            raw = open(path, "wb")
+            return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(raw), encoding="utf-8")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb")), encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def read_manifest(path: str) -> dict | None:
+    mpath = os.path.join(path, "manifest.json")
+    if not os.path.exists(mpath):
+        return None
+    with open(mpath, encoding="utf-8") as f:
+        return json.load(f)
+
+def corpus_urls(path: str) -> set[str]:
+    m = read_manifest(path)
+    return set(m["urls"]) if m else set()
+
+def iter_records(path: str, kind: str) -> Iterator[dict]:
+    m = read_manifest(path)
+    if m is None:
+        return
+    for shard in m["shards"][kind]:
+        with _open(os.path.join(path, shard["file"]), "r", m["compression"]) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def iter_pages(path: str) -> Iterator[dict]:
+    return iter_records(path, "pages")
+
+def iter_chunks(path: str) -> Iterator[dict]:
+    return iter_records(path, "chunks")
+
+class CorpusWriter:
+    """
+    Пишет новое поколение корпуса; до commit() читатели видят старое.
+    """
+
+    def __init__(self, path: str, shard_bytes: int = 64 << 20, compression: str = "none"):
+        os.makedirs(path, exist_ok=True)
+        self.path        = path
+        self.shard_bytes = shard_bytes
+        self.compression = compression
+        self.gen         = f"g{time.time_ns()}"
+        self.ext         = ".jsonl.zst" if compression == "zstd" else ".jsonl"
+        self.shards      = {k: [] for k in KINDS}
+        self.urls: set[str] = set()
+        self._files      = {}
+
+    def _file(self, kind: str):
+        cur = self._files.get(kind)
+        if cur is not None and cur[2] < self.shard_bytes:
+            return cur
+        if cur is not None:
+            cur[0].close()
+        name = f"{self.gen}-{kind}-{len(self.shards[kind]):05d}{self.ext}"
+        self.shards[kind].append({"file": name, "records": 0})
+        cur = [_open(os.path.join(self.path, name), "w", self.compression), self.shards[kind][-1], 0]
+        self._files[kind] = cur
+        return cur
+
+    def write(self, kind: str, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        cur  = self._file(kind)
+        cur[0].write(line)
+        cur[1]["records"] += 1
+        # размер считаем по несжатым данным — для ротации этого достаточно
+        cur[2] += len(line.encode("utf-8"))
+
+    def add_page(self, page: dict) -> None:
+        """
+        page — словарь страницы с ключом "chunks", как раньше в raw_json.
+        """
+        self.urls.add(page["page_url"])
+        self.write("pages", {k: v for k, v in page.items() if k != "chunks"})
+        for ch in page["chunks"]:
+            self.write("chunks", {
+                "page_url":   page["page_url"],
+                "page_title": page["page_title"],
+                "page_lang":  page["page_lang"],
+                **ch
+            })
+
+    def copy_from(self, path: str, urls: set[str]) -> None:
+        """
+        Переносит из текущего корпуса страницы и чанки для urls (неизменившиеся страницы).
+        """
+        for kind in KINDS:
+            for rec in iter_records(path, kind):
+                if rec["page_url"] in urls:
+                    self.urls.add(rec["page_url"])
+                    self.write(kind, rec)
+
+    def commit(self) -> None:
+        for f, _, _ in self._files.values():
+            f.close()
+        self._files.clear()
+        manifest = {
+            "generation":  self.gen,
+            "compression": self.compression,
+            "shards":      self.shards,
+            "urls":        sorted(self.urls),
+        }
+        tmp = os.path.join(self.path, "manifest.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, os.path.join(self.path, "manifest.json"))
+
+        # шарды прошлых поколений больше не нужны
+        live = {s["file"] for k in KINDS for s in self.shards[k]}
+        for fn in os.listdir(self.path):
+            if fn.startswith("g") and "-" in fn and fn not in live:
+                os.remove(os.path.join(self.path, fn))
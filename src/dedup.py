@@ -0,0 +1,120 @@
+# src/dedup.py
+
+import re
+import zlib
+import logging
+
+import numpy as np
+
+logger = logging.getLogger("dedup")
+
+PRIME = np.uint64(4294967311)   # простое > 2^32 для универсального хэширования
+EMPTY = np.iinfo(np.uint32).max  # подпись чанка без слов — ни с кем не сравнивается
+
+class MinHasher:
+    """
+    MinHash-подписи чанков по словесным шинглам + LSH по полосам подписи.
+    Оценка Jaccard двух чанков = доля совпавших позиций подписи.
+    """
+
+    def __init__(self, num_perm: int = 128, bands: int = 16, shingle: int = 5, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.num_perm = num_perm
+        self.bands    = bands
+        self.rows     = num_perm // bands
+        self.shingle  = shingle
+        rng = np.random.default_rng(seed)
+        # a, b < 2^31: a*x + b не переполняет uint64 при x < 2^32
+        self.a = rng.integers(1, 1 << 31, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 31, size=(num_perm, 1), dtype=np.uint64)
+
+    def shingles(self, text: str) -> np.ndarray:
+        words = re.findall(r"\w+", text.lower())
+        if not words:
+            return np.zeros(0, dtype=np.uint64)
+        n = max(len(words) - self.shingle + 1, 1)
+        grams = {" ".join(words[i:i + self.shingle]) for i in range(n)}
+        return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+
+    def signature(self, text: str) -> np.ndarray:
+        x = self.shingles(text)
+        if len(x) == 0:
+            return np.full(self.num_perm, EMPTY, dtype=np.uint32)
+        return ((self.a * x[None, :] + self.b) % PRIME).min(axis=1).astype(np.uint32)
+
+    def candidates(self, sigs: np.ndarray):
+        """
+        Пары (i, j) из общих LSH-корзин: каждый член корзины — с её первым элементом.
+        Чанки без слов (пустая подпись) в корзины не попадают.
+        """
+        empty = (sigs == EMPTY).all(axis=1)
+        for band in range(self.bands):
+            part = np.ascontiguousarray(sigs[:, band * self.rows:(band + 1) * self.rows])
+            buckets: dict[bytes, int] = {}
+            for i, row in enumerate(part):
+                if empty[i]:
+                    continue
+                first = buckets.setdefault(row.tobytes(), i)
+                if first != i:
+                    yield first, i
+
+def find_duplicates(sigs: np.ndarray, hasher: MinHasher, threshold: float = 0.85) -> np.ndarray:
+    """
+    Кластеры почти-дубликатов (union-find по проверенным LSH-кандидатам).
+    Возвращает для каждого чанка номер канонического — наименьший номер в кластере.
+    Цепочек нет: кластеры сливаются, только если каждый член присоединяемого
+    похож на канонический чанк (A~B и B~C без A~C не объединяют A с C).
+    """
+    parent = np.arange(len(sigs))
+    members: dict[int, list[int]] = {}
+    similar = lambda a, b: np.mean(sigs[a] == sigs[b]) >= threshold
+
+    def root(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    checked: set[tuple[int, int]] = set()
+    for i, j in hasher.candidates(sigs):
+        ri, rj = root(i), root(j)
+        if ri == rj or (i, j) in checked:
+            continue
+        checked.add((i, j))
+        if not similar(i, j):
+            continue
+        r, o = min(ri, rj), max(ri, rj)
+        absorbed = members.get(o, [o])
+        if all(similar(r, m) for m in absorbed):
+            parent[o] = r
+            members[r] = members.get(r, [r]) + absorbed
+            members.pop(o, None)
+    return np.array([root(i) for i in range(len(sigs))])
+
+def plan(chunks, hasher: MinHasher, threshold: float = 0.85) -> tuple[np.ndarray, dict[int, list[str]]]:
+    """
+    Один проход по чанкам: подписи → кластеры.
+    Возвращает номер канонического чанка для каждого и, для канонических
+    с дубликатами на других страницах, список всех URL-источников (для цитат).
+    """
+    sigs, urls = [], []
+    for ch in chunks:
+        sigs.append(hasher.signature(ch["text"]))
+        urls.append(ch["page_url"])
+    if not sigs:
+        return np.zeros(0, dtype=np.int64), {}
+    canon = find_duplicates(np.stack(sigs), hasher, threshold)
+
+    sources: dict[int, list[str]] = {}
+    for i in np.flatnonzero(canon != np.arange(len(canon))):
+        c = int(canon[i])
+        sources.setdefault(c, [urls[c]])
+        if urls[i] not in sources[c]:
+            sources[c].append(urls[i])
+    sources = {c: s for c, s in sources.items() if len(s) > 1}
+
+    kept = int((canon == np.arange(len(canon))).sum())
+    logger.info(f"Dedup: {len(canon)} chunks → {kept} canonical "
+                f"(ratio {1 - kept / len(canon):.1%}, {len(sources)} with several sources)")
+    return canon, sources
@@ -2,13 +2,19 @@
 
 import os
 import json
-import pickle
+import hashlib
 import logging
 import yaml
+from itertools import islice
 
 import numpy as np
 from sentence_transformers import SentenceTransformer
 
+import dedup
+import vectors
+from corpus  import iter_chunks
+from vectors import VectorFile
+
 def load_config():
     src  = os.path.dirname(os.path.abspath(__file__))
     root = os.path.dirname(src)
@@ -24,33 +30,185 @@ logger = logging.getLogger("embed")
 cfg  = load_config()
 ROOT = project_root()
 
-RAW_JSON = os.path.join(ROOT, cfg["data"]["raw_json_dir"])
+CORPUS   = os.path.join(ROOT, cfg["data"].get("corpus_dir", "data/corpus"))
 EMB_DIR  = os.path.join(ROOT, cfg["data"]["embeddings_dir"])
 os.makedirs(EMB_DIR, exist_ok=True)
 
-texts = []
-meta  = []
+MODEL_NAME = cfg["embed"]["model_name"]
+BATCH      = cfg["embed"]["batch_size"]
+DTYPE      = cfg["embed"].get("storage_dtype", "float32")   # float32 | float16 | int8
+
+EMB_PATH   = os.path.join(EMB_DIR, "embeddings.npy")
+META_PATH  = os.path.join(EMB_DIR, "metadata.jsonl")
+PROGRESS   = os.path.join(EMB_DIR, "embeddings.progress.json")
+TMP_PATH   = os.path.join(EMB_DIR, "embeddings.partial.npy")
+DEDUP_PATH = os.path.join(EMB_DIR, "dedup.json")
+
+dedup_cfg       = cfg.get("dedup", {})
+DEDUP           = dedup_cfg.get("enabled", True)
+DEDUP_THRESHOLD = dedup_cfg.get("threshold", 0.85)
+
+# Кэш эмбеддингов: (model_name, sha256 текста чанка) → вектор.
+# Для каждой модели и формата хранения свои файлы, так что смена
+# embed.model_name / storage_dtype не смешивает векторы.
+CACHE_DIR  = os.path.join(EMB_DIR, "cache")
+CACHE_NS   = "".join(c if c.isalnum() or c in "-." else "_" for c in MODEL_NAME) + f"__{DTYPE}"
+CACHE_KEYS = os.path.join(CACHE_DIR, f"{CACHE_NS}.keys.npy")
+CACHE_VECS = os.path.join(CACHE_DIR, f"{CACHE_NS}.npy")
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def batched(it, n):
+    it = iter(it)
+    while batch := list(islice(it, n)):
+        yield batch
+
+def load_cache() -> tuple[dict[str, int], VectorFile | None]:
+    if not (os.path.exists(CACHE_KEYS) and os.path.exists(CACHE_VECS)):
+        return {}, None
+    keys = np.load(CACHE_KEYS)
+    return {k.decode("ascii"): i for i, k in enumerate(keys)}, VectorFile(CACHE_VECS)
+
+def write_cache(hashes: list[str], out: VectorFile) -> None:
+    """
+    Новый кэш = по одной строке на уникальный живой хэш (устаревшие записи
+    отпадают сами). Копируется блоками из готовых embeddings.npy.
+    """
+    first = {}
+    for i, h in enumerate(hashes):
+        first.setdefault(h, i)
+    rows = np.fromiter(first.values(), dtype="int64", count=len(first))
+    tmp  = CACHE_VECS[:-len(".npy")] + ".tmp.npy"
+    vecs, scale = vectors.create(tmp, len(rows), out.shape[1], DTYPE)
+    for a in range(0, len(rows), 4096):
+        part = rows[a:a + 4096]
+        vecs[a:a + len(part)] = out.vecs[part]
+        if scale is not None:
+            scale[a:a + len(part)] = out.scale[part]
+    vecs.flush()
+    del vecs
+    if scale is not None:
+        scale.flush()
+        del scale
+        os.replace(vectors.scale_path(tmp), vectors.scale_path(CACHE_VECS))
+    os.replace(tmp, CACHE_VECS)
+    np.save(CACHE_KEYS, np.array(list(first), dtype="S64"))
+
+def canonical_chunks():
+    """
+    Чанки корпуса без почти-дубликатов: остаётся первый из кластера,
+    URL остальных страниц кластера — в его поле "sources".
+    """
+    for i, ch in enumerate(iter_chunks(CORPUS)):
+        if canon is None or canon[i] == i:
+            if i in sources:
+                ch["sources"] = sources[i]
+            yield ch
+
+# 0) Дедупликация: MinHash/LSH-подписи всех чанков → кластеры почти-дубликатов
+canon, sources = None, {}
+if DEDUP:
+    hasher = dedup.MinHasher(
+        num_perm=dedup_cfg.get("num_perm", 128),
+        bands=dedup_cfg.get("bands", 16),
+        shingle=dedup_cfg.get("shingle", 5),
+    )
+    canon, sources = dedup.plan(iter_chunks(CORPUS), hasher, DEDUP_THRESHOLD)
 
-for fn in os.listdir(RAW_JSON):
-    if not fn.endswith(".json"):
+# 1) Первый проход по корпусу: хэши текстов и metadata.jsonl (построчно)
+hashes = []
+with open(META_PATH + ".tmp", "w", encoding="utf-8") as f:
+    for ch in canonical_chunks():
+        hashes.append(text_hash(ch["text"]))
+        f.write(json.dumps(ch, ensure_ascii=False) + "\n")
+n = len(hashes)
+logger.info(f"Loaded {n} chunks")
+if n == 0:
+    raise SystemExit("Corpus is empty — run `python -m src.ingest` first")
+total = len(canon) if canon is not None else n
+with open(DEDUP_PATH, "w", encoding="utf-8") as f:
+    json.dump({
+        "chunks":         total,
+        "canonical":      n,
+        "dedup_ratio":    round(1 - n / total, 4),
+        "multi_source":   len(sources),
+        "threshold":      DEDUP_THRESHOLD if DEDUP else None,
+    }, f, ensure_ascii=False, indent=2)
+
+run_id = hashlib.sha256(f"{MODEL_NAME}|{DTYPE}|{BATCH}|{''.join(hashes)}".encode()).hexdigest()
+cache_rows, cache = load_cache()
+
+model = None
+def get_model() -> SentenceTransformer:
+    global model
+    if model is None:
+        model = SentenceTransformer(MODEL_NAME)
+    return model
+
+d = cache.shape[1] if cache is not None else get_model().get_sentence_embedding_dimension()
+
+# 2) Предвыделенный memmap; после сбоя продолжаем с последнего готового батча
+done = 0
+if os.path.exists(PROGRESS) and os.path.exists(TMP_PATH):
+    with open(PROGRESS, encoding="utf-8") as f:
+        progress = json.load(f)
+    if progress.get("run_id") == run_id:
+        done = progress["rows_done"]
+        logger.info(f"Resuming from row {done}/{n}")
+if done:
+    out_vecs  = np.load(TMP_PATH, mmap_mode="r+")
+    out_scale = np.load(vectors.scale_path(TMP_PATH), mmap_mode="r+") if DTYPE == "int8" else None
+else:
+    out_vecs, out_scale = vectors.create(TMP_PATH, n, d, DTYPE)
+
+# 3) Второй проход: батчами, только промахи кэша идут в model.encode
+hits = misses = 0
+pos  = 0
+for batch in batched(canonical_chunks(), BATCH):
+    a, b = pos, pos + len(batch)
+    pos  = b
+    if b <= done:
         continue
-    page = json.load(open(os.path.join(RAW_JSON, fn), encoding="utf-8"))
-    for ch in page["chunks"]:
-        texts.append(ch["text"])
-        meta.append({
-            "page_url":   page["page_url"],
-            "page_title": page["page_title"],
-            "page_lang":  page["page_lang"],
-            **ch
-        })
-
-logger.info(f"Loaded {len(texts)} chunks")
-
-model = SentenceTransformer(cfg["embed"]["model_name"])
-embs  = model.encode(texts, batch_size=cfg["embed"]["batch_size"], show_progress_bar=True)
-
-np.save(os.path.join(EMB_DIR, "embeddings.npy"), embs.astype("float32"))
-with open(os.path.join(EMB_DIR, "metadata.pkl"), "wb") as f:
-    pickle.dump(meta, f)
+    bh   = hashes[a:b]
+    miss = [i for i, h in enumerate(bh) if h not in cache_rows]
+    hit  = [i for i, h in enumerate(bh) if h in cache_rows]
+    if hit:
+        src = np.array([cache_rows[bh[i]] for i in hit])
+        out_vecs[a + np.array(hit)] = cache.vecs[src]
+        if out_scale is not None:
+            out_scale[a + np.array(hit)] = cache.scale[src]
+    if miss:
+        enc = get_model().encode([batch[i]["text"] for i in miss], batch_size=BATCH)
+        q, scale = vectors.quantize(enc, DTYPE)
+        out_vecs[a + np.array(miss)] = q
+        if out_scale is not None:
+            out_scale[a + np.array(miss)] = scale
+    hits, misses = hits + len(hit), misses + len(miss)
+
+    out_vecs.flush()
+    if out_scale is not None:
+        out_scale.flush()
+    with open(PROGRESS, "w", encoding="utf-8") as f:
+        json.dump({"run_id": run_id, "rows_done": b}, f)
+
+logger.info(f"Embedding cache: {hits} hits, {misses} encoded")
+
+# 4) Публикация: memmap закрываем до замены файлов (иначе не сработает на Windows)
+del out_vecs, out_scale
+if cache is not None:
+    cache.close()
+if DTYPE == "int8":
+    os.replace(vectors.scale_path(TMP_PATH), vectors.scale_path(EMB_PATH))
+elif os.path.exists(vectors.scale_path(EMB_PATH)):
+    os.remove(vectors.scale_path(EMB_PATH))
+os.replace(TMP_PATH, EMB_PATH)
+os.replace(META_PATH + ".tmp", META_PATH)
+os.remove(PROGRESS)
+
+out = VectorFile(EMB_PATH)
+write_cache(hashes, out)
+out.close()
 
 logger.info("Embeddings and metadata saved.")
@@ -0,0 +1,141 @@
+# src/index_bench.py
+#
+# Бенчмарк ANN-индексов на нашем корпусе:
+#   python -m src.index_bench [--queries test/test.txt ...] [--dry-run]
+# Для каждого кандидата factory_string: recall@k относительно точного поиска,
+# p50/p99 задержки одного запроса, время сборки и размер индекса.
+# Лучший кандидат (самый быстрый с recall >= index.bench_recall_floor)
+# записывается в config.yaml → index.factory_string.
+
+import os
+import re
+import csv
+import sys
+import time
+import argparse
+import logging
+
+import numpy as np
+import faiss
+
+import indexer
+from indexer import build_full, cfg, ROOT, emb_path, METRIC
+from vectors import VectorFile
+
+logger = logging.getLogger("index_bench")
+
+TOP_K       = cfg["retrieve"]["top_k"]
+RECALL_MIN  = cfg["index"].get("bench_recall_floor", 0.95)
+CANDIDATES  = cfg["index"].get("bench_candidates") or ["Flat", "HNSW32", "IVF{nlist},Flat", "IVF{nlist},PQ{m}"]
+
+def expand(template: str, n: int, d: int) -> str | None:
+    nlist = max(1, int(4 * np.sqrt(n)))
+    # PQ: m должно делить d; берём ~8 измерений на субквантователь
+    m = next((m for m in (d // 8, 48, 32, 16, 8) if m and d % m == 0), None)
+    if "{m}" in template and m is None:
+        return None
+    return template.format(nlist=nlist, m=m)
+
+def load_questions(paths: list[str]) -> list[str]:
+    qs = []
+    for p in paths:
+        with open(p, encoding="utf-8") as f:
+            for row in csv.DictReader(f, delimiter="\t"):
+                q = (row.get("Вопрос") or "").strip()
+                if q:
+                    qs.append(q)
+    return qs
+
+def query_vectors(emb: VectorFile, paths: list[str], sample: int) -> np.ndarray:
+    parts = []
+    qs = load_questions(paths)
+    if qs:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(cfg["embed"]["model_name"])
+        parts.append(model.encode(qs, normalize_embeddings=True).astype("float32"))
+        logger.info(f"{len(qs)} labelled questions")
+    if sample:
+        # дополняем запросы векторами самого корпуса
+        rows = np.sort(np.random.default_rng(1).choice(len(emb), size=min(sample, len(emb)), replace=False))
+        parts.append(emb.take(rows, normalize=True))
+    return np.ascontiguousarray(np.vstack(parts), dtype="float32")
+
+def exact_topk(emb: VectorFile, Q: np.ndarray, k: int) -> np.ndarray:
+    flat = faiss.IndexFlat(emb.shape[1], METRIC)
+    for _, block in emb.iter_blocks(indexer.ADD_BLOCK, normalize=True):
+        flat.add(block)
+    return flat.search(Q, k)[1]
+
+def bench_one(factory: str, emb: VectorFile, Q: np.ndarray, gt: np.ndarray, k: int) -> dict:
+    ids = np.arange(len(emb), dtype="int64")
+    t0  = time.perf_counter()
+    idx = build_full(emb, ids, factory)
+    build_s = time.perf_counter() - t0
+
+    lat = []
+    found = np.empty_like(gt)
+    for i in range(len(Q)):
+        t = time.perf_counter()
+        found[i] = idx.search(Q[i:i + 1], k)[1][0]
+        lat.append(time.perf_counter() - t)
+    recall = np.mean([len(set(f) & set(g)) / k for f, g in zip(found, gt)])
+    lat_ms = np.array(lat) * 1000
+    return {
+        "factory": factory,
+        "recall":  float(recall),
+        "p50_ms":  float(np.percentile(lat_ms, 50)),
+        "p99_ms":  float(np.percentile(lat_ms, 99)),
+        "build_s": build_s,
+        "size_mb": faiss.serialize_index(idx).nbytes / 2**20,
+    }
+
+def write_factory(factory: str) -> None:
+    path = os.path.join(ROOT, "config.yaml")
+    with open(path, encoding="utf-8", newline="") as f:
+        text = f.read()
+    # правим только значение, комментарии и форматирование сохраняются
+    text = re.sub(r'(factory_string:\s*)"[^"]*"', lambda m: f'{m.group(1)}"{factory}"', text, count=1)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(text)
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark FAISS factory strings on the current embeddings")
+    ap.add_argument("--queries", nargs="*", default=[os.path.join(ROOT, "test", "test.txt")])
+    ap.add_argument("--sample",  type=int, default=200, help="extra queries sampled from the corpus")
+    ap.add_argument("--k",       type=int, default=TOP_K)
+    ap.add_argument("--dry-run", action="store_true", help="do not write config.yaml")
+    args = ap.parse_args()
+
+    emb = VectorFile(emb_path)
+    n, d = emb.shape
+    k = min(args.k, n)
+    Q  = query_vectors(emb, args.queries, args.sample)
+    gt = exact_topk(emb, Q, k)
+
+    results = []
+    for tpl in CANDIDATES:
+        factory = expand(tpl, n, d)
+        if factory is None:
+            continue
+        try:
+            results.append(bench_one(factory, emb, Q, gt, k))
+        except RuntimeError as e:
+            # например, IVF/PQ на слишком маленьком корпусе
+            logger.warning(f"[SKIP] {factory}: {e}")
+
+    print(f"\n{'factory':<22}{'recall@'+str(k):>10}{'p50 ms':>10}{'p99 ms':>10}{'build s':>10}{'size MB':>10}")
+    for r in results:
+        print(f"{r['factory']:<22}{r['recall']:>10.3f}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['build_s']:>10.2f}{r['size_mb']:>10.2f}")
+
+    ok = [r for r in results if r["recall"] >= RECALL_MIN]
+    if not ok:
+        print(f"\nNo candidate reaches recall >= {RECALL_MIN}; config unchanged.")
+        sys.exit(1)
+    best = min(ok, key=lambda r: (r["p50_ms"], r["size_mb"]))
+    print(f"\nBest: {best['factory']} (recall {best['recall']:.3f}, p50 {best['p50_ms']:.3f} ms)")
+    if not args.dry_run:
+        write_factory(best["factory"])
+        print("config.yaml → index.factory_string updated; rebuild with `python -m src.indexer`.")
+
+if __name__ == "__main__":
+    main()
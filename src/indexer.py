@@ -1,13 +1,21 @@
 # src/indexer.py
 
 import os
-import pickle
+import json
+import time
+import shutil
+import hashlib
 import logging
 import yaml
 
 import numpy as np
 import faiss
 
+from chunkstore import ChunkStore, write_store
+from lexical    import write_bm25
+from vectors    import VectorFile
+from lang       import norm_lang
+
 def load_config():
     src  = os.path.dirname(os.path.abspath(__file__))
     root = os.path.dirname(src)
@@ -17,6 +25,16 @@ def load_config():
 def project_root():
     return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+def chunk_uid(page_url: str, chunk_id: int) -> int:
+    """
+    Стабильный 63-битный ID чанка (FAISS хранит ID как int64).
+    """
+    h = hashlib.sha1(f"{page_url}#{chunk_id}".encode("utf-8")).digest()
+    return int.from_bytes(h[:8], "little") & 0x7FFF_FFFF_FFFF_FFFF
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
 logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
 logger = logging.getLogger("indexer")
 
@@ -26,35 +44,228 @@ ROOT = project_root()
 EMB_DIR    = os.path.join(ROOT, cfg["data"]["embeddings_dir"])
 INDEX_DIR  = os.path.join(ROOT, cfg["data"]["faiss_index_dir"])
 FACTORY    = cfg["index"]["factory_string"]
+MODE       = cfg["index"].get("mode", "full")
+DRIFT_MAX  = cfg["index"].get("retrain_drift", 0.2)
+KEEP_SNAPS = cfg["index"].get("keep_snapshots", 2)
+ADD_BLOCK  = cfg["index"].get("add_block", 65536)       # строк на один idx.add из memmap
+TRAIN_MAX  = cfg["index"].get("train_sample", 100000)   # векторов для обучения IVF/PQ
+NPROBE     = cfg["index"].get("nprobe", 16)             # списков IVF, просматриваемых при поиске
+LANG_SHARDS = cfg["index"].get("lang_shards", True)     # отдельный индекс на каждый язык + "all"
+SHARD_MIN   = cfg["index"].get("lang_shard_min", 50)    # меньше чанков — язык ищется только в "all"
+BM25        = cfg["index"].get("bm25", True)            # лексический индекс для гибридного поиска
+# Векторы нормируются, метрика — inner product: score = косинус,
+# ровно как у запросов (normalize_embeddings=True в retriever.py)
+METRIC     = faiss.METRIC_INNER_PRODUCT
 os.makedirs(INDEX_DIR, exist_ok=True)
 
-emb_path  = os.path.join(EMB_DIR, "embeddings.npy")
-meta_path = os.path.join(EMB_DIR, "metadata.pkl")
-idx_path  = os.path.join(INDEX_DIR, "index.faiss")
-m_out     = os.path.join(INDEX_DIR, "metadata.pkl")
+emb_path   = os.path.join(EMB_DIR, "embeddings.npy")
+meta_path  = os.path.join(EMB_DIR, "metadata.jsonl")
+# Каждая сборка — отдельный снимок INDEX_DIR/snap-<ns>/ (index.faiss, chunks/, index_state.json),
+# а VERSION хранит имя текущего снимка: индекс и метаданные всегда меняются вместе.
+ver_path   = os.path.join(INDEX_DIR, "VERSION")
+
+def current_snapshot() -> str | None:
+    if not os.path.exists(ver_path):
+        return None
+    with open(ver_path, encoding="utf-8") as f:
+        path = os.path.join(INDEX_DIR, f.read().strip())
+    return path if os.path.isdir(path) else None
+
+def gc_snapshots(keep: int) -> None:
+    snaps = sorted(d for d in os.listdir(INDEX_DIR) if d.startswith("snap-") and not d.endswith(".tmp"))
+    for d in snaps[:-keep] if keep > 0 else []:
+        # открытые через mmap файлы остаются доступны процессам, которые их держат
+        shutil.rmtree(os.path.join(INDEX_DIR, d), ignore_errors=True)
+
+def publish(path: str, write) -> None:
+    """
+    write(tmp_path) пишет во временный файл, затем os.replace атомарно
+    подменяет целевой — читатели не увидят полузаписанный файл.
+    """
+    tmp = f"{path}.tmp"
+    write(tmp)
+    os.replace(tmp, path)
+
+def dump_text(text: str):
+    def _write(p):
+        with open(p, "w", encoding="utf-8") as f:
+            f.write(text)
+    return _write
+
+def dump_json(obj):
+    def _write(p):
+        with open(p, "w", encoding="utf-8") as f:
+            json.dump(obj, f, indent=2)
+    return _write
+
+def needs_training(d: int, factory: str = FACTORY) -> bool:
+    return not faiss.index_factory(d, factory, METRIC).is_trained
+
+def set_nprobe(idx: faiss.Index, nprobe: int = NPROBE) -> None:
+    try:
+        faiss.extract_index_ivf(idx).nprobe = nprobe
+    except RuntimeError:
+        pass  # не IVF
+
+def build_full(emb: VectorFile, ids: np.ndarray, factory: str = FACTORY,
+               rows: np.ndarray | None = None) -> faiss.Index:
+    """
+    rows — подмножество строк (для языкового шарда), None — все.
+    """
+    n = len(emb) if rows is None else len(rows)
+    d = emb.shape[1]
+    logger.info(f"Building index [IDMap2,{factory}] on dim={d}, {n} vectors")
+    idx = faiss.index_factory(d, "IDMap2," + factory, METRIC)
+
+    if not idx.is_trained:
+        # обучаем на случайной выборке, а не на всей матрице
+        sample = np.sort(np.random.default_rng(0).choice(n, size=min(n, TRAIN_MAX), replace=False))
+        if rows is not None:
+            sample = rows[sample]
+        logger.info(f"Training on {len(sample)} vectors…")
+        idx.train(emb.take(sample, normalize=True))
+        logger.info("Trained.")
+
+    logger.info("Adding vectors…")
+    for part, block in emb.iter_blocks(ADD_BLOCK, rows, normalize=True):
+        idx.add_with_ids(block, ids[part])
+    set_nprobe(idx)
+    return idx
+
+def update_incremental(idx: faiss.Index, old_meta: dict, emb: VectorFile,
+                       ids: np.ndarray, new_meta: dict) -> tuple[int, int]:
+    """
+    Обновляет только изменившиеся страницы: их старые векторы удаляются,
+    новые добавляются с теми же стабильными ID. Возвращает (added, removed).
+    """
+    old_pages: dict[str, set[int]] = {}
+    for uid, m in old_meta.items():
+        old_pages.setdefault(m["page_url"], set()).add(uid)
+    new_pages: dict[str, set[int]] = {}
+    for uid, m in new_meta.items():
+        new_pages.setdefault(m["page_url"], set()).add(uid)
+
+    def page_changed(url: str) -> bool:
+        if old_pages.get(url) != new_pages.get(url):
+            return True
+        return any(old_meta[u]["text_hash"] != new_meta[u]["text_hash"] for u in new_pages[url])
+
+    dirty = [u for u in set(old_pages) | set(new_pages) if page_changed(u)]
+    to_remove = [uid for u in dirty for uid in old_pages.get(u, ())]
+    to_add    = {uid for u in dirty for uid in new_pages.get(u, ())}
+
+    if to_remove:
+        idx.remove_ids(np.array(to_remove, dtype="int64"))
+    if to_add:
+        rows = np.nonzero(np.isin(ids, np.fromiter(to_add, dtype="int64")))[0]
+        for part, block in emb.iter_blocks(ADD_BLOCK, rows, normalize=True):
+            idx.add_with_ids(block, ids[part])
+
+    logger.info(f"Incremental update: {len(dirty)} pages, +{len(to_add)} / -{len(to_remove)} vectors")
+    return len(to_add), len(to_remove)
+
+if __name__ == "__main__":
+    # memmap: в память читаются только блоки, которые добавляются в индекс
+    emb = VectorFile(emb_path)
+    logger.info(f"Opened embeddings: {emb.shape} {emb.vecs.dtype}")
+
+    with open(meta_path, encoding="utf-8") as f:
+        meta = [json.loads(line) for line in f if line.strip()]
+
+    # Метаданные по стабильным ID вместо номера строки
+    ids      = np.array([chunk_uid(m["page_url"], m["chunk_id"]) for m in meta], dtype="int64")
+    meta_map = {int(uid): {**m, "text_hash": text_hash(m["text"])} for uid, m in zip(ids, meta)}
+
+    d     = emb.shape[1]
+    prev  = current_snapshot()
+    state = {}
+    if prev and os.path.exists(os.path.join(prev, "index_state.json")):
+        with open(os.path.join(prev, "index_state.json"), encoding="utf-8") as f:
+            state = json.load(f)
+
+    can_update = (
+        MODE == "incremental"
+        and prev is not None
+        and state.get("factory") == FACTORY
+        and state.get("dim") == d
+        and state.get("metric") == "ip"
+    )
+    trained = needs_training(d)
+    if can_update and trained and state.get("drift", 0) / max(state.get("trained_ntotal", 1), 1) > DRIFT_MAX:
+        # центроиды IVF/PQ устарели — переобучаем с нуля
+        logger.info("Drift above threshold, scheduling full retrain")
+        can_update = False
 
-emb = np.load(emb_path).astype("float32")
-emb = np.ascontiguousarray(emb)
-logger.info(f"Loaded embeddings: {emb.shape}")
+    # Языковые шарды: "all" + по индексу на каждый достаточно крупный язык
+    langs = np.array([norm_lang(m.get("page_lang")) for m in meta])
+    shard_rows = {"all": None}
+    if LANG_SHARDS:
+        for lang in sorted(set(langs)):
+            rows = np.nonzero(langs == lang)[0]
+            if len(rows) >= SHARD_MIN and len(rows) < len(meta):
+                shard_rows[lang] = rows
 
-with open(meta_path, "rb") as f:
-    meta = pickle.load(f)
+    def shard_file(shard: str) -> str:
+        return "index.faiss" if shard == "all" else f"index.{shard}.faiss"
 
-d = emb.shape[1]
-logger.info(f"Building index [{FACTORY}] on dim={d}")
-idx = faiss.index_factory(d, FACTORY)
+    shards = {}
+    # языки, шард которых не собрался в прошлый раз, тоже считаются «как раньше» —
+    # иначе каждый следующий запуск уходил бы в полную пересборку
+    prev_shards = set(state.get("shards", ["all"])) | set(state.get("skipped_shards", []))
+    if can_update and prev_shards == set(shard_rows):
+        old_meta = ChunkStore(os.path.join(prev, "chunks")).summary()
+        try:
+            added = removed = 0
+            for shard in sorted(set(shard_rows) - set(state.get("skipped_shards", []))):
+                keep = (lambda m: True) if shard == "all" else (lambda m, s=shard: norm_lang(m.get("page_lang")) == s)
+                idx  = faiss.read_index(os.path.join(prev, shard_file(shard)))
+                a, r = update_incremental(
+                    idx,
+                    {u: m for u, m in old_meta.items() if keep(m)},
+                    emb, ids,
+                    {u: m for u, m in meta_map.items() if keep(m)},
+                )
+                shards[shard] = idx
+                if shard == "all":
+                    added, removed = a, r
+            state["drift"] = state.get("drift", 0) + added + removed
+        except RuntimeError as e:
+            # например, HNSW не поддерживает remove_ids
+            logger.warning(f"Incremental update not supported ({e}), rebuilding")
+            shards = {}
 
-if not idx.is_trained:
-    logger.info("Training…")
-    idx.train(emb)
-    logger.info("Trained.")
+    if not shards:
+        skipped = []
+        for shard, rows in shard_rows.items():
+            try:
+                shards[shard] = build_full(emb, ids, rows=rows)
+            except RuntimeError as e:
+                if shard == "all":
+                    raise
+                # например, IVF с nlist больше, чем чанков в языке
+                logger.warning(f"Skipping language shard [{shard}]: {e}")
+                skipped.append(shard)
+        state = {"factory": FACTORY, "dim": d, "metric": "ip",
+                 "trained_ntotal": int(shards["all"].ntotal), "drift": 0, "skipped_shards": skipped}
+    state["shards"] = sorted(shards)
 
-logger.info("Adding vectors…")
-idx.add(emb)
-logger.info(f"Total vectors: {idx.ntotal}")
+    for shard, idx in shards.items():
+        logger.info(f"Total vectors [{shard}]: {idx.ntotal}")
 
-logger.info(f"Writing index → {idx_path}")
-faiss.write_index(idx, idx_path)
-with open(m_out, "wb") as f:
-    pickle.dump(meta, f)
-logger.info("Saved index and metadata.")
+    name = f"snap-{time.time_ns()}"
+    tmp  = os.path.join(INDEX_DIR, name + ".tmp")
+    out  = os.path.join(INDEX_DIR, name)
+    os.makedirs(tmp)
+    logger.info(f"Writing snapshot → {out}")
+    for shard, idx in shards.items():
+        faiss.write_index(idx, os.path.join(tmp, shard_file(shard)))
+    write_store(os.path.join(tmp, "chunks"), meta_map)
+    if BM25:
+        # дёшево по сравнению с эмбеддингами — пересобирается целиком в каждом снимке
+        write_bm25(os.path.join(tmp, "bm25"), meta_map)
+    dump_json(state)(os.path.join(tmp, "index_state.json"))
+    os.replace(tmp, out)
+    # VERSION последним: бот переключается на снимок только когда он записан целиком
+    publish(ver_path, dump_text(name))
+    gc_snapshots(KEEP_SNAPS)
+    logger.info("Saved index and metadata.")
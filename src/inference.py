@@ -0,0 +1,124 @@
+# src/inference.py
+#
+# Загрузка эмбеддера вопросов и cross-encoder'а с выбранным бэкендом CPU-инференса:
+#   torch — обычная модель sentence-transformers (fp32)
+#   int8  — та же модель, Linear-слои динамически квантованы в int8 (torch.quantization)
+#   onnx  — экспорт в ONNX Runtime; необязательная зависимость:
+#           pip install "sentence-transformers[onnx]>=4.1" (backend= у CrossEncoder — с 4.1); onnx_file —
+#           например onnx/model_qint8_avx2.onnx после export_dynamic_quantized_onnx_model
+# Бэкенд, отличный от torch, включается только если src/inference_parity.py
+# подтвердил совпадение ранжирования с torch-моделью (запись в parity-файле);
+# иначе — предупреждение и torch.
+
+import os
+import json
+import logging
+import importlib.util
+import yaml
+
+def load_config():
+    src  = os.path.dirname(os.path.abspath(__file__))
+    root = os.path.dirname(src)
+    with open(os.path.join(root, "config.yaml"), encoding="utf-8") as f:
+        return yaml.safe_load(f)
+
+def project_root():
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+logger = logging.getLogger("inference")
+
+cfg  = load_config()
+ROOT = project_root()
+
+BACKENDS    = ("torch", "int8", "onnx")
+ONNX_EXTRA  = 'pip install "sentence-transformers[onnx]>=4.1"'
+PARITY_PATH = os.path.join(ROOT, cfg.get("eval", {}).get("parity_file", "data/inference_parity.json"))
+
+def parity_key(model_name: str, backend: str, onnx_file: str | None = None) -> str:
+    return f"{model_name}|{backend}|{onnx_file or ''}"
+
+def load_parity() -> dict:
+    try:
+        with open(PARITY_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_parity(key: str, record: dict) -> None:
+    records = load_parity()
+    records[key] = record
+    os.makedirs(os.path.dirname(PARITY_PATH), exist_ok=True)
+    tmp = PARITY_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, PARITY_PATH)
+
+def certified(model_name: str, backend: str, onnx_file: str | None = None) -> bool:
+    if backend == "torch":
+        return True
+    return bool(load_parity().get(parity_key(model_name, backend, onnx_file), {}).get("passed"))
+
+def set_threads(threads: int | None) -> None:
+    # число потоков torch — на весь процесс (эмбеддер и reranker делят пул),
+    # поэтому в config.yaml одна настройка retrieve.inference_threads
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+
+def onnx_kwargs(onnx_file: str | None, threads: int | None) -> dict:
+    missing = [m for m in ("onnxruntime", "optimum") if importlib.util.find_spec(m) is None]
+    if missing:
+        raise ImportError(f"onnx backend needs {', '.join(missing)}: {ONNX_EXTRA}")
+    kwargs = {"provider": "CPUExecutionProvider"}
+    if onnx_file:
+        kwargs["file_name"] = onnx_file
+    if threads:
+        import onnxruntime as ort
+        so = ort.SessionOptions()
+        so.intra_op_num_threads = threads
+        so.inter_op_num_threads = 1
+        kwargs["session_options"] = so
+    return kwargs
+
+def quantize(module):
+    import torch
+    return torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+def checked_backend(model_name: str, backend: str, onnx_file: str | None, force: bool) -> str:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {BACKENDS}")
+    if force or certified(model_name, backend, onnx_file):
+        return backend
+    logger.warning(f"{backend} backend for {model_name} has no passing parity check "
+                   f"(python -m src.inference_parity), using torch")
+    return "torch"
+
+def load_embedder(model_name: str, backend: str = "torch", onnx_file: str | None = None,
+                  threads: int | None = None, force: bool = False):
+    """
+    force=True — без проверки parity-файла (для самой проверки).
+    """
+    from sentence_transformers import SentenceTransformer
+    backend = checked_backend(model_name, backend, onnx_file, force)
+    logger.info(f"Loading embedder {model_name} [{backend}]")
+    if backend == "onnx":
+        return SentenceTransformer(model_name, device="cpu", backend="onnx",
+                                   model_kwargs=onnx_kwargs(onnx_file, threads))
+    set_threads(threads)
+    model = SentenceTransformer(model_name, device="cpu" if backend == "int8" else None)
+    # SentenceTransformer — nn.Sequential: квантуются Linear-слои трансформера внутри
+    return quantize(model) if backend == "int8" else model
+
+def load_cross_encoder(model_name: str, backend: str = "torch", onnx_file: str | None = None,
+                       threads: int | None = None, force: bool = False):
+    from sentence_transformers import CrossEncoder
+    backend = checked_backend(model_name, backend, onnx_file, force)
+    logger.info(f"Loading cross-encoder {model_name} [{backend}]")
+    if backend == "onnx":
+        return CrossEncoder(model_name, device="cpu", backend="onnx",
+                            model_kwargs=onnx_kwargs(onnx_file, threads))
+    set_threads(threads)
+    model = CrossEncoder(model_name, device="cpu" if backend == "int8" else None)
+    if backend == "int8":
+        model.model = quantize(model.model)
+    return model
@@ -0,0 +1,131 @@
+# src/inference_parity.py
+#
+# Проверка бэкенда CPU-инференса (src/inference.py) перед включением:
+#   python -m src.inference_parity --target embed                   # бэкенд из embed.query_backend
+#   python -m src.inference_parity --target reranker --backend int8
+#   python -m src.inference_parity --target embed --backend onnx --onnx-file onnx/model_qint8_avx2.onnx
+# На вопросах из test/*.txt сравнивает с torch-моделью то, что видит бот:
+# embed — top_k чанков текущего индекса, reranker — top rerank_k из тех же кандидатов.
+# Результат (совпадение, задержки) пишется в eval.parity_file; retriever включает
+# бэкенд только при passed = true для этой модели, бэкенда и onnx-файла.
+
+import sys
+import time
+import argparse
+import logging
+
+import numpy as np
+
+import inference
+import retriever
+from retrieval_eval import load_labels
+from inference import cfg, ROOT
+
+logger = logging.getLogger("inference_parity")
+
+EVAL_CFG    = cfg.get("eval", {})
+MIN_OVERLAP = EVAL_CFG.get("parity_min_overlap", 0.95)   # средняя доля общих результатов
+MIN_TOP1    = EVAL_CFG.get("parity_min_top1", 0.95)      # доля вопросов с тем же первым результатом
+
+def encode_each(model, qs: list[str]) -> tuple[np.ndarray, float]:
+    """
+    Вопросы по одному, как их кодирует бот; (векторы, p50 мс на вопрос).
+    """
+    vecs, lat = [], []
+    for q in qs:
+        t = time.perf_counter()
+        vecs.append(model.encode([q], normalize_embeddings=True)[0])
+        lat.append(time.perf_counter() - t)
+    return np.ascontiguousarray(np.vstack(vecs), dtype="float32"), float(np.percentile(lat, 50) * 1000)
+
+def rerank_each(model, qs: list[str], texts: list[list[str]], k: int) -> tuple[list[list[int]], float]:
+    """
+    Номера top-k кандидатов каждого вопроса по оценке reranker'а; p50 мс на вопрос.
+    """
+    tops, lat = [], []
+    for q, cands in zip(qs, texts):
+        t = time.perf_counter()
+        scores = np.asarray(model.predict([[q, c] for c in cands]), dtype="float32")
+        lat.append(time.perf_counter() - t)
+        tops.append(list(np.argsort(-scores, kind="stable")[:k]))
+    return tops, float(np.percentile(lat, 50) * 1000)
+
+def agreement(ref: list, cand: list) -> tuple[float, float]:
+    """
+    (средняя доля общих результатов, доля совпавших top-1).
+    """
+    overlap = np.mean([len(set(r) & set(c)) / max(len(r), 1) for r, c in zip(ref, cand)])
+    top1    = np.mean([bool(r) and bool(c) and r[0] == c[0] for r, c in zip(ref, cand)])
+    return float(overlap), float(top1)
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Ranking parity of an inference backend against torch")
+    ap.add_argument("--target",    choices=["embed", "reranker"], default="embed")
+    ap.add_argument("--backend",   choices=inference.BACKENDS[1:], help="по умолчанию — из config.yaml")
+    ap.add_argument("--onnx-file", help="по умолчанию — из config.yaml")
+    ap.add_argument("--threads",   type=int)
+    ap.add_argument("--labels",    nargs="+", default=[f"{ROOT}/test/test.txt", f"{ROOT}/test/ytest.txt"])
+    args = ap.parse_args()
+
+    if args.target == "embed":
+        name    = retriever.EMB_MOD
+        backend = args.backend or retriever.EMB_BACKEND
+        onnx    = args.onnx_file or retriever.EMB_ONNX
+    else:
+        name    = retriever.CE_MOD
+        backend = args.backend or retriever.CE_BACKEND
+        onnx    = args.onnx_file or retriever.CE_ONNX
+        if not name:
+            raise SystemExit("retrieve.cross_encoder_model is not set")
+    threads = args.threads or retriever.THREADS
+    if backend == "torch":
+        raise SystemExit("torch is the reference backend — pass --backend int8 or onnx")
+    if backend != "onnx":
+        onnx = None
+
+    qs = load_labels(args.labels)[0]
+    if not qs:
+        raise SystemExit("No questions")
+    st = retriever.current_state()
+
+    # эталонные кандидаты: torch-эмбеддер на текущем индексе
+    ref_emb = inference.load_embedder(retriever.EMB_MOD, "torch", threads=threads, force=True)
+    Qr, ref_emb_ms = encode_each(ref_emb, qs)
+    _, Ir = retriever.search(st, st.index, Qr, ())
+    ref_ids = [[int(i) for i in row if i >= 0] for row in Ir]
+
+    record = {"target": args.target, "questions": len(qs), "index_version": st.version, "threads": threads}
+    if args.target == "embed":
+        model = inference.load_embedder(name, backend, onnx, threads, force=True)
+        Qc, ms = encode_each(model, qs)
+        _, Ic = retriever.search(st, st.index, Qc, ())
+        overlap, top1 = agreement(ref_ids, [[int(i) for i in row if i >= 0] for row in Ic])
+        record.update(min_cosine=round(float((Qr * Qc).sum(axis=1).min()), 4), ref_ms=ref_emb_ms, ms=ms)
+    else:
+        texts = [[st.metadata[u]["text"] for u in ids] for ids in ref_ids]
+        ref_ce = inference.load_cross_encoder(name, "torch", threads=threads, force=True)
+        ref_top, ref_ms = rerank_each(ref_ce, qs, texts, retriever.RR_K)
+        model = inference.load_cross_encoder(name, backend, onnx, threads, force=True)
+        top, ms = rerank_each(model, qs, texts, retriever.RR_K)
+        overlap, top1 = agreement(ref_top, top)
+        record.update(ref_ms=ref_ms, ms=ms)
+
+    passed = overlap >= MIN_OVERLAP and top1 >= MIN_TOP1
+    record.update(overlap=round(overlap, 4), top1=round(top1, 4), passed=passed,
+                  checked_at=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    inference.save_parity(inference.parity_key(name, backend, onnx), record)
+
+    k = retriever.TOP_K if args.target == "embed" else retriever.RR_K
+    print(f"\n{name} [{backend}{' ' + onnx if onnx else ''}] vs torch on {len(qs)} questions")
+    print(f"overlap@{k} {overlap:.3f} (min {MIN_OVERLAP})  top-1 {top1:.3f} (min {MIN_TOP1})")
+    print(f"p50 latency {record['ref_ms']:.2f} → {record['ms']:.2f} ms/query")
+    if not passed:
+        print("\nFAILED: backend stays disabled")
+        return 1
+    key = "embed.query_backend" if args.target == "embed" else "retrieve.reranker_backend"
+    print(f"\nPASSED: set {key}: {backend} in config.yaml")
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -1,15 +1,23 @@
 # src/ingest.py
 
 import os
+import re
+import sys
 import json
+import glob
+import bisect
 import asyncio
+import hashlib
 import logging
 import yaml
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 import aiohttp
+import lxml.html
 from readability import Document
-from bs4 import BeautifulSoup, Doctype, NavigableString, Tag
-from transformers import AutoTokenizer
+
+from corpus import CorpusWriter, corpus_urls
 
 # ——— Config loader and helpers —————————————————————————————————
 def load_config() -> dict:
@@ -24,55 +32,68 @@ def project_root() -> str:
 def sanitize(url: str) -> str:
     return ''.join(c if c.isalnum() or c == '-' else '_' for c in url)
 
-def detect_lang_from_soup(soup: BeautifulSoup) -> str:
-    html_tag = soup.find("html")
-    if html_tag and html_tag.get("lang", "").strip():
-        return html_tag["lang"].strip()
-    text = soup.get_text(" ", strip=True)
+def content_hash(text: str) -> str:
+    # нормализуем пробелы и регистр, чтобы косметика вёрстки не считалась изменением
+    norm = re.sub(r"\s+", " ", text).strip().lower()
+    return hashlib.sha256(norm.encode("utf-8")).hexdigest()
+
+def element_text(el, sep: str = " ") -> str:
+    # аналог BeautifulSoup.get_text(sep, strip=True)
+    return sep.join(t.strip() for t in el.itertext() if t.strip())
+
+def detect_lang(tree) -> str:
+    lang = (tree.get("lang") or "").strip()
+    if lang:
+        return lang
+    text = element_text(tree)
     from langdetect import detect, LangDetectException
     try:
         return detect(text)
     except LangDetectException:
         return "unknown"
 
-def extract_markdown(soup: BeautifulSoup) -> str:
-    SKIP = ["nav", "footer", "aside", "script", "style"]
-    for tag in soup.find_all(SKIP):
-        tag.decompose()
+SKIP_TAGS = {"nav", "footer", "aside", "script", "style"}
 
-    def _rec(t: Tag) -> str:
-        parts = []
-        for c in t.children:
-            if isinstance(c, Doctype):
+def extract_markdown(tree) -> str:
+    """
+    Markdown-представление страницы. Дерево не изменяется: пропускаемые
+    теги просто не обходятся, поэтому его потом можно отдать readability.
+    """
+    def _rec(el) -> str:
+        parts = [el.text or ""]
+        for c in el:
+            if not isinstance(c.tag, str):
+                # комментарии и processing instructions
+                parts.append(c.tail or "")
                 continue
-            if isinstance(c, NavigableString):
-                parts.append(str(c))
-            elif isinstance(c, Tag):
-                n = c.name.lower()
-                if n in ("h1", "h2", "h3", "h4", "h5", "h6"):
-                    lvl = int(n[1])
-                    parts.append(f"\n{'#'*lvl} {c.get_text(strip=True)}\n\n")
-                elif n == "p":
-                    parts.append(_rec(c) + "\n\n")
-                elif n in ("strong", "b"):
-                    parts.append(f"**{c.get_text(strip=True)}**")
-                elif n in ("em", "i"):
-                    parts.append(f"_{c.get_text(strip=True)}_")
-                elif n == "a":
-                    parts.append(f"[{c.get_text(strip=True)}]({c.get('href')})")
-                elif n == "ul":
-                    for li in c.find_all("li", recursive=False):
-                        parts.append(f"- {_rec(li)}\n")
-                elif n == "ol":
-                    for i, li in enumerate(c.find_all("li", recursive=False), 1):
-                        parts.append(f"{i}. {_rec(li)}\n")
-                elif n == "img":
-                    parts.append(f"![{c.get('alt','')}]({c.get('src')})")
-                else:
-                    parts.append(_rec(c))
+            n = c.tag.lower()
+            if n in SKIP_TAGS:
+                pass
+            elif n in ("h1", "h2", "h3", "h4", "h5", "h6"):
+                lvl = int(n[1])
+                parts.append(f"\n{'#'*lvl} {element_text(c, '')}\n\n")
+            elif n == "p":
+                parts.append(_rec(c) + "\n\n")
+            elif n in ("strong", "b"):
+                parts.append(f"**{element_text(c, '')}**")
+            elif n in ("em", "i"):
+                parts.append(f"_{element_text(c, '')}_")
+            elif n == "a":
+                parts.append(f"[{element_text(c, '')}]({c.get('href')})")
+            elif n == "ul":
+                for li in c.findall("li"):
+                    parts.append(f"- {_rec(li)}\n")
+            elif n == "ol":
+                for i, li in enumerate(c.findall("li"), 1):
+                    parts.append(f"{i}. {_rec(li)}\n")
+            elif n == "img":
+                parts.append(f"![{c.get('alt','')}]({c.get('src')})")
+            else:
+                parts.append(_rec(c))
+            parts.append(c.tail or "")
         return "".join(parts)
 
-    md = _rec(soup)
+    md = _rec(tree)
     # удаляем лишние пустые строки
     return "\n\n".join([b.strip() for b in md.splitlines() if b.strip()])
 
@@ -86,99 +107,351 @@ ROOT = project_root()
 RAW_HTML = os.path.join(ROOT, cfg["data"]["raw_html_dir"])
 RAW_JSON = os.path.join(ROOT, cfg["data"]["raw_json_dir"])
 CHUNKS   = os.path.join(ROOT, cfg["data"]["chunks_dir"])
+CORPUS   = os.path.join(ROOT, cfg["data"].get("corpus_dir", "data/corpus"))
 os.makedirs(RAW_HTML, exist_ok=True)
-os.makedirs(RAW_JSON, exist_ok=True)
-os.makedirs(CHUNKS,   exist_ok=True)
+
+CORPUS_CFG  = cfg.get("corpus", {})
+SHARD_BYTES = CORPUS_CFG.get("shard_mb", 64) << 20
+COMPRESSION = CORPUS_CFG.get("compression", "none")      # none | zstd
+# Старый формат (JSON на страницу в raw_json + JSON на чанк в chunks) — по желанию
+EXPORT_JSON = CORPUS_CFG.get("export_json", False)
+if EXPORT_JSON:
+    os.makedirs(RAW_JSON, exist_ok=True)
+    os.makedirs(CHUNKS,   exist_ok=True)
+
+MANIFEST = os.path.join(ROOT, cfg["data"].get("ingest_manifest", "data/ingest_manifest.json"))
+DELTA    = os.path.join(ROOT, cfg["data"].get("ingest_delta",    "data/ingest_delta.json"))
 
 URLS       = cfg["urls"]
 MAX_WORK   = cfg["ingest"]["max_fetch_workers"]
 TIMEOUT    = cfg["ingest"]["request_timeout"]
 CHUNK_SZ   = cfg["ingest"]["chunk_size"]
 OVERLAP    = cfg["ingest"]["chunk_overlap"]
+PARSE_WORK = cfg["ingest"].get("parse_workers") or os.cpu_count() or 1
+PARSE_Q    = cfg["ingest"].get("parse_queue", 2 * PARSE_WORK)
+PARSE_B    = cfg["ingest"].get("parse_batch", 4)
+SNAP       = cfg["ingest"].get("chunk_snap", "sentence")   # none | sentence | heading
+SNAP_MIN   = 0.5   # окно можно укоротить до границы не больше чем вдвое
 
-tokenizer = AutoTokenizer.from_pretrained(cfg["embed"]["model_name"])
 HEADERS   = {"User-Agent":"Mozilla/5.0"}
 
-def chunk_text(text: str) -> list[dict]:
-    ids   = tokenizer.encode(text, add_special_tokens=False)
-    chunks = []
-    step  = CHUNK_SZ - OVERLAP
-    for i in range(0, len(ids), step):
-        win = ids[i:i+CHUNK_SZ]
-        txt = tokenizer.decode(win, clean_up_tokenization_spaces=True)
-        chunks.append({
-            "chunk_id":    len(chunks),
-            "text":        txt,
-            "start_token": i,
-            "end_token":   min(i+CHUNK_SZ, len(ids))
-        })
-        if i + CHUNK_SZ >= len(ids):
-            break
-    return chunks
-
-async def fetch_parse(session, url, sem):
-    async with sem:
-        try:
-            async with session.get(url, headers=HEADERS) as resp:
-                resp.raise_for_status()
-                html = await resp.text()
-        except Exception as e:
-            logger.warning(f"[FETCH ERR] {url}: {e}")
-            return
+# Токенизатор живёт только в процессах-парсерах: грузится один раз на процесс
+tokenizer = None
 
-    fn = sanitize(url)
-    # 1) Сохраняем raw HTML
-    with open(os.path.join(RAW_HTML, f"{fn}.html"), "w", encoding="utf-8") as f:
-        f.write(html)
+def init_parse_worker() -> None:
+    global tokenizer
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(cfg["embed"]["model_name"])
+    if not tokenizer.is_fast:
+        raise ValueError("chunking needs a fast tokenizer (offset mapping)")
+
+def load_manifest() -> dict:
+    if not os.path.exists(MANIFEST):
+        return {}
+    with open(MANIFEST, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest: dict) -> None:
+    tmp = MANIFEST + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, MANIFEST)
 
-    # 2) Readability → основной HTML + текст
-    doc       = Document(html)
-    main_html = doc.summary()
-    main_txt  = BeautifulSoup(main_html, "html.parser").get_text(" ", strip=True)
-
-    # 3) Язык и заголовок
-    soup      = BeautifulSoup(html, "html.parser")
-    lang      = detect_lang_from_soup(soup)
-    title     = soup.title.string.strip() if soup.title else ""
-
-    # 4) Markdown-альтернатива
-    md        = extract_markdown(soup)
-
-    # 5) Чанки
-    chunks    = chunk_text(main_txt)
-
-    # 6) Сохраняем JSON страницы
-    page = {
-        "page_url":   url,
-        "page_title": title,
-        "page_lang":  lang,
-        "main_html":  main_html,
-        "main_text":  main_txt,
-        "md_text":    md,
-        "chunks":     chunks
+def remove_page_files(fn: str) -> None:
+    for path in [os.path.join(RAW_HTML, f"{fn}.html"), os.path.join(RAW_JSON, f"{fn}.json")]:
+        if os.path.exists(path):
+            os.remove(path)
+    remove_chunk_files(fn)
+
+def remove_chunk_files(fn: str) -> None:
+    for path in glob.glob(os.path.join(CHUNKS, f"{glob.escape(fn)}_chunk_*.json")):
+        os.remove(path)
+
+SENT_END = re.compile(r"[.!?…](?=\s)")
+
+def boundary_chars(text: str, md: str) -> list[int]:
+    """
+    Позиции символов в text, с которых удобно начинать новый чанк:
+    заголовки из markdown и (для SNAP=sentence) начала предложений.
+    """
+    bounds = set()
+    for line in md.splitlines():
+        if line.startswith("#"):
+            head = line.lstrip("#").strip()
+            pos  = text.find(head) if head else -1
+            if pos > 0:
+                bounds.add(pos)
+    if SNAP == "sentence":
+        for m in SENT_END.finditer(text):
+            bounds.add(m.end() + 1)
+    return sorted(bounds)
+
+def chunk_texts(texts: list[str], mds: list[str] | None = None) -> list[list[dict]]:
+    """
+    Чанкинг по offset mapping быстрого токенизатора: все страницы
+    токенизируются одним вызовом, текст чанка — точный срез исходной строки
+    (без decode). При SNAP != none конец окна сдвигается на ближайшую
+    границу предложения/заголовка.
+    """
+    enc = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True)
+    out = []
+    for n_page, (text, offs) in enumerate(zip(texts, enc["offset_mapping"])):
+        n      = len(offs)
+        starts = [o[0] for o in offs]
+        tok_bounds = []
+        if SNAP != "none" and mds is not None:
+            tok_bounds = sorted({bisect.bisect_left(starts, b) for b in boundary_chars(text, mds[n_page])})
+
+        chunks = []
+        i = 0
+        while i < n:
+            end = min(i + CHUNK_SZ, n)
+            if tok_bounds and end < n:
+                # последняя граница внутри окна, но не раньше его середины
+                k = bisect.bisect_right(tok_bounds, end) - 1
+                if k >= 0 and tok_bounds[k] >= i + int(CHUNK_SZ * SNAP_MIN):
+                    end = tok_bounds[k]
+            chunks.append({
+                "chunk_id":    len(chunks),
+                "text":        text[offs[i][0]:offs[end - 1][1]],
+                "start_token": i,
+                "end_token":   end
+            })
+            if end >= n:
+                break
+            i = max(end - OVERLAP, i + 1)
+        out.append(chunks)
+    return out
+
+def parse_page(url: str, html: str, prev_hash: str | None) -> dict:
+    """
+    CPU-часть (выполняется в ProcessPoolExecutor): одно lxml-дерево на страницу,
+    из него заголовок, язык, markdown и основной текст (readability).
+    Чанки добавляет parse_pages — для всей пачки сразу; если основной
+    текст не изменился (prev_hash), страница не чанкуется.
+    """
+    tree  = lxml.html.document_fromstring(html)
+    title_el = tree.find(".//title")
+    title = (title_el.text or "").strip() if title_el is not None else ""
+    lang  = detect_lang(tree)
+    md    = extract_markdown(tree)
+
+    # readability изменяет дерево, поэтому идёт последней
+    main_html = Document(tree).summary()
+    main_txt  = element_text(lxml.html.fragment_fromstring(main_html, create_parent="div"))
+
+    h = content_hash(main_txt)
+    if h == prev_hash:
+        return {"content_hash": h, "unchanged": True}
+
+    return {
+        "content_hash": h,
+        "unchanged":    False,
+        "page": {
+            "page_url":   url,
+            "page_title": title,
+            "page_lang":  lang,
+            "main_html":  main_html,
+            "main_text":  main_txt,
+            "md_text":    md,
+        },
     }
+
+def parse_pages(items: list[tuple[str, str, str | None]]) -> list[dict]:
+    """
+    Парсит пачку страниц и чанкует изменившиеся одним вызовом токенизатора.
+    Ошибка разбора одной страницы не роняет пачку: вместо результата — {"error": …}.
+    """
+    results = []
+    for url, html, prev_hash in items:
+        try:
+            results.append(parse_page(url, html, prev_hash))
+        except Exception as e:
+            results.append({"error": f"{type(e).__name__}: {e}"})
+    todo    = [r["page"] for r in results if "error" not in r and not r["unchanged"]]
+    if todo:
+        for page, chunks in zip(todo, chunk_texts([p["main_text"] for p in todo], [p["md_text"] for p in todo])):
+            page["chunks"] = chunks
+    return results
+
+def export_page(fn: str, page: dict) -> None:
+    """
+    Экспорт в старый формат: JSON страницы в raw_json + по файлу на чанк в chunks.
+    """
+    # Сохраняем JSON страницы
     with open(os.path.join(RAW_JSON, f"{fn}.json"), "w", encoding="utf-8") as f:
         json.dump(page, f, ensure_ascii=False, indent=2)
 
-    # 7) Сохраняем по отдельности каждый чан
-    for ch in chunks:
+    # Сохраняем по отдельности каждый чанк (старые чанки страницы удаляем)
+    remove_chunk_files(fn)
+    for ch in page["chunks"]:
         out = {
-            "page_url":   url,
-            "page_title": title,
-            "page_lang":  lang,
+            "page_url":   page["page_url"],
+            "page_title": page["page_title"],
+            "page_lang":  page["page_lang"],
             "chunk_id":   ch["chunk_id"],
             "text":       ch["text"]
         }
         with open(os.path.join(CHUNKS, f"{fn}_chunk_{ch['chunk_id']}.json"), "w", encoding="utf-8") as f:
             json.dump(out, f, ensure_ascii=False, indent=2)
 
-    logger.info(f"[PARSED] {url}: {len(chunks)} chunks")
+async def fetch(session, url, sem, manifest: dict, force: bool,
+                known: set[str], queue: asyncio.Queue) -> str | None:
+    """
+    Стадия 1: скачивает страницу и кладёт её в очередь на парсинг.
+    known — URL, страницы которых уже есть в корпусе.
+    Возвращает статус, если парсинг не нужен (unchanged | failed), иначе None.
+    """
+    fn   = sanitize(url)
+    prev = manifest.get(url) if not force else None
+    if prev and url not in known:
+        prev = None
+
+    # Условный GET: сервер ответит 304, если страница не менялась
+    headers = dict(HEADERS)
+    if prev:
+        if prev.get("etag"):
+            headers["If-None-Match"] = prev["etag"]
+        if prev.get("last_modified"):
+            headers["If-Modified-Since"] = prev["last_modified"]
+
+    async with sem:
+        try:
+            async with session.get(url, headers=headers) as resp:
+                if resp.status == 304 and prev:
+                    logger.info(f"[304] {url}")
+                    return "unchanged"
+                resp.raise_for_status()
+                html = await resp.text()
+                etag          = resp.headers.get("ETag")
+                last_modified = resp.headers.get("Last-Modified")
+        except Exception as e:
+            logger.warning(f"[FETCH ERR] {url}: {e}")
+            return "failed"
+
+    entry = {
+        "file":          fn,
+        "etag":          etag,
+        "last_modified": last_modified,
+        "html_hash":     hashlib.sha256(html.encode("utf-8")).hexdigest(),
+        "fetched_at":    datetime.now().isoformat(timespec="seconds"),
+    }
+    # Тот же HTML байт в байт — не парсим вовсе
+    if prev and prev.get("html_hash") == entry["html_hash"]:
+        manifest[url] = {**prev, **entry}
+        logger.info(f"[SAME HTML] {url}")
+        return "unchanged"
+
+    # Сохраняем raw HTML
+    with open(os.path.join(RAW_HTML, f"{fn}.html"), "w", encoding="utf-8") as f:
+        f.write(html)
+
+    # Ограниченная очередь: фетчеры ждут, если парсеры не успевают
+    await queue.put((url, html, prev, entry))
+    return None
+
+async def parse_consumer(queue: asyncio.Queue, pool: ProcessPoolExecutor,
+                         manifest: dict, statuses: dict, writer: CorpusWriter) -> None:
+    """
+    Стадия 2: забирает из очереди до PARSE_B страниц, отдаёт пачку
+    в пул процессов и пишет результат.
+    """
+    loop = asyncio.get_running_loop()
+    done = False
+    while not done:
+        # None — сигнал остановки; чужие None из очереди не забираем
+        item  = await queue.get()
+        batch = []
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= PARSE_B or queue.empty():
+                break
+            item = queue.get_nowait()
+        done = item is None
+        try:
+            if not batch:
+                continue
+            try:
+                results = await loop.run_in_executor(
+                    pool, parse_pages,
+                    [(url, html, prev.get("content_hash") if prev else None) for url, html, prev, _ in batch]
+                )
+            except Exception as e:
+                for url, *_ in batch:
+                    logger.warning(f"[PARSE ERR] {url}: {e}")
+                    statuses[url] = "failed"
+                continue
+
+            for (url, _, prev, entry), res in zip(batch, results):
+                if "error" in res:
+                    logger.warning(f"[PARSE ERR] {url}: {res['error']}")
+                    statuses[url] = "failed"
+                    continue
+                entry["content_hash"] = res["content_hash"]
+                if res["unchanged"]:
+                    # поменялись баннеры, счётчики и т.п. — чанки те же
+                    manifest[url] = {**prev, **entry}
+                    logger.info(f"[SAME TEXT] {url}")
+                    statuses[url] = "unchanged"
+                else:
+                    writer.add_page(res["page"])
+                    if EXPORT_JSON:
+                        export_page(entry["file"], res["page"])
+                    manifest[url] = entry
+                    logger.info(f"[PARSED] {url}: {len(res['page']['chunks'])} chunks")
+                    statuses[url] = "changed" if prev else "added"
+        finally:
+            for _ in range(len(batch) + (1 if done else 0)):
+                queue.task_done()
+
+async def main(force: bool = False):
+    manifest = load_manifest()
+    sem      = asyncio.Semaphore(MAX_WORK)
+    queue    = asyncio.Queue(maxsize=PARSE_Q)
+    statuses: dict[str, str] = {}
+    to       = aiohttp.ClientTimeout(total=TIMEOUT)
+    known    = corpus_urls(CORPUS)
+    writer   = CorpusWriter(CORPUS, SHARD_BYTES, COMPRESSION)
+
+    with ProcessPoolExecutor(max_workers=PARSE_WORK, initializer=init_parse_worker) as pool:
+        consumers = [
+            asyncio.create_task(parse_consumer(queue, pool, manifest, statuses, writer))
+            for _ in range(PARSE_WORK)
+        ]
+        async with aiohttp.ClientSession(timeout=to) as s:
+            fetched = await asyncio.gather(*(fetch(s, u, sem, manifest, force, known, queue) for u in URLS))
+        for url, st in zip(URLS, fetched):
+            if st is not None:
+                statuses[url] = st
+        for _ in consumers:
+            await queue.put(None)
+        await asyncio.gather(*consumers)
+
+    delta = {"added": [], "changed": [], "unchanged": [], "failed": [], "removed": []}
+    for url in URLS:
+        delta[statuses[url]].append(url)
+
+    # Страницы, которых больше нет в config.yaml
+    for url in sorted(set(manifest) - set(URLS)):
+        remove_page_files(manifest.pop(url)["file"])
+        delta["removed"].append(url)
+
+    # Неизменившиеся страницы (и недоступные сейчас, но известные) переносим из прошлого поколения
+    keep = {u for u in URLS if u in known and statuses[u] in ("unchanged", "failed")}
+    writer.copy_from(CORPUS, keep)
+    writer.commit()
+
+    save_manifest(manifest)
+    with open(DELTA, "w", encoding="utf-8") as f:
+        json.dump(delta, f, ensure_ascii=False, indent=2)
 
-async def main():
-    sem     = asyncio.Semaphore(MAX_WORK)
-    to      = aiohttp.ClientTimeout(total=TIMEOUT)
-    async with aiohttp.ClientSession(timeout=to) as s:
-        await asyncio.gather(*(fetch_parse(s, u, sem) for u in URLS))
+    logger.info(
+        "Ingest done: " + ", ".join(f"{k}={len(v)}" for k, v in delta.items())
+    )
+    for k in ("added", "changed", "removed", "failed"):
+        for url in delta[k]:
+            logger.info(f"  [{k.upper()}] {url}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # --force: игнорировать манифест и перепарсить всё
+    asyncio.run(main(force="--force" in sys.argv[1:]))
@@ -0,0 +1,32 @@
+# src/lang.py
+
+import re
+
+# Буквы, которые есть в казахском, но не в русском алфавите
+KK_CHARS = set("әғқңөұүһіӘҒҚҢӨҰҮҺІ")
+CYR = re.compile(r"[А-Яа-яЁё]")
+LAT = re.compile(r"[A-Za-z]")
+
+def norm_lang(lang: str | None) -> str:
+    """
+    "ru-RU" → "ru", "kz" → "kk", пусто → "unknown".
+    """
+    lang = (lang or "").strip().lower().replace("_", "-").split("-")[0]
+    if lang == "kz":
+        return "kk"
+    return lang or "unknown"
+
+def detect_query_lang(text: str) -> str:
+    """
+    Быстрое определение языка вопроса по алфавиту: langdetect на коротких
+    вопросах ошибается чаще, чем эта эвристика для ru / kk / en.
+    Хватает одной кириллической буквы: в русских вопросах латиницей пишутся
+    названия («Где находится Astana IT University?»), обратное почти не встречается.
+    """
+    if any(c in KK_CHARS for c in text):
+        return "kk"
+    if CYR.search(text):
+        return "ru"
+    if LAT.search(text):
+        return "en"
+    return "unknown"
@@ -0,0 +1,131 @@
+# src/lexical.py
+
+import os
+import re
+import json
+import math
+from collections import Counter
+
+import numpy as np
+
+# Лексический BM25-индекс снимка (рядом с chunks/, строится индексатором):
+#   vocab.json        — отсортированный словарь терминов
+#   offsets.npy int64 — границы списков термина в docs/tf (len(vocab) + 1)
+#   docs.npy    int32 — номера строк документов, по возрастанию внутри термина
+#   tf.npy      uint16 — частота термина в документе
+#   ids.npy     int64 — uid чанка для строки (тот же порядок, что в chunks/)
+#   doc_len.npy int32 — длина документа в токенах
+#   stats.json        — {"n", "avgdl"}
+# Постинги открываются через mmap, в памяти только словарь.
+
+TOKEN_RE = re.compile(r"\w+")
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_RE.findall(text.lower())
+
+def is_keyword_query(query: str, max_words: int = 3) -> bool:
+    """
+    Короткий запрос из ключевых слов («ЕНТ», «стоимость обучения SE»),
+    а не вопрос: для него хватает лексического поиска.
+    """
+    return "?" not in query and 0 < len(tokenize(query)) <= max_words
+
+def write_bm25(path: str, meta: dict[int, dict]) -> None:
+    """
+    meta: {uid: {"text", …}} — тот же словарь, что у write_store.
+    """
+    os.makedirs(path, exist_ok=True)
+    uids = np.array(sorted(meta), dtype="int64")
+    vocab: dict[str, int] = {}
+    terms, rows, freqs = [], [], []
+    doc_len = np.empty(len(uids), dtype="int32")
+    for i, uid in enumerate(uids):
+        tokens = tokenize(meta[int(uid)]["text"])
+        doc_len[i] = len(tokens)
+        for tok, tf in Counter(tokens).items():
+            terms.append(vocab.setdefault(tok, len(vocab)))
+            rows.append(i)
+            freqs.append(min(tf, 65535))
+
+    # номера терминов → в порядке отсортированного словаря
+    words = sorted(vocab)
+    remap = np.empty(len(vocab), dtype="int64")
+    remap[[vocab[w] for w in words]] = np.arange(len(words))
+    terms = remap[np.array(terms, dtype="int64")] if terms else np.zeros(0, dtype="int64")
+    order = np.argsort(terms, kind="stable")   # внутри термина строки остаются по возрастанию
+
+    offsets = np.zeros(len(words) + 1, dtype="int64")
+    np.cumsum(np.bincount(terms, minlength=len(words)), out=offsets[1:])
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "docs.npy"), np.array(rows, dtype="int32")[order])
+    np.save(os.path.join(path, "tf.npy"), np.array(freqs, dtype="uint16")[order])
+    np.save(os.path.join(path, "ids.npy"), uids)
+    np.save(os.path.join(path, "doc_len.npy"), doc_len)
+    with open(os.path.join(path, "vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(words, f, ensure_ascii=False)
+    with open(os.path.join(path, "stats.json"), "w", encoding="utf-8") as f:
+        json.dump({"n": len(uids), "avgdl": float(doc_len.mean()) if len(uids) else 0.0}, f)
+
+class BM25Index:
+    """
+    Read-only BM25 по снимку: search(query) → [(uid, score), …] по убыванию.
+    """
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1, self.b = k1, b
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        self.offsets = load("offsets.npy")
+        self.docs    = load("docs.npy")
+        self.tf      = load("tf.npy")
+        self.ids     = load("ids.npy")
+        self.doc_len = load("doc_len.npy")
+        with open(os.path.join(path, "vocab.json"), encoding="utf-8") as f:
+            self.vocab = {w: i for i, w in enumerate(json.load(f))}
+        with open(os.path.join(path, "stats.json"), encoding="utf-8") as f:
+            stats = json.load(f)
+        self.n, self.avgdl = stats["n"], stats["avgdl"] or 1.0
+
+    def __len__(self) -> int:
+        return self.n
+
+    def search(self, query: str, k: int, allowed: np.ndarray | None = None) -> list[tuple[int, float]]:
+        """
+        allowed — uid, которыми ограничен поиск (фильтры по метаданным).
+        """
+        docs, weights = [], []
+        for tok in set(tokenize(query)):
+            t = self.vocab.get(tok)
+            if t is None:
+                continue
+            a, z = self.offsets[t], self.offsets[t + 1]
+            rows = np.asarray(self.docs[a:z])
+            tf   = np.asarray(self.tf[a:z], dtype="float32")
+            idf  = math.log(1 + (self.n - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[rows] / self.avgdl)
+            docs.append(rows)
+            weights.append(idf * tf * (self.k1 + 1) / (tf + norm))
+        if not docs:
+            return []
+
+        rows, inv = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.bincount(inv, weights=np.concatenate(weights))
+        uids   = np.asarray(self.ids[rows])
+        if allowed is not None:
+            keep = np.isin(uids, allowed)
+            uids, scores = uids[keep], scores[keep]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+            uids, scores = uids[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return [(int(uids[i]), float(scores[i])) for i in order]
+
+def rrf(rankings: list[list[tuple[int, float]]], k: int = 60) -> list[tuple[int, float]]:
+    """
+    Reciprocal rank fusion: score(uid) = Σ 1 / (k + rank) по всем спискам.
+    """
+    fused: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, (uid, _) in enumerate(ranking, start=1):
+            fused[uid] = fused.get(uid, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda x: x[1], reverse=True)
@@ -0,0 +1,173 @@
+# src/metrics.py
+
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger("metrics")
+
+# секунды: от быстрых стадий (FAISS) до долгой генерации на CPU
+TIME_BUCKETS  = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS  = (1, 2, 5, 10, 20, 40, 80, 160)
+
+class Histogram:
+    """
+    Гистограмма в формате Prometheus (кумулятивные бакеты, _sum, _count) с метками.
+    Потокобезопасна: стадии пишутся из CPU-пула и батчеров.
+    """
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (), buckets=TIME_BUCKETS):
+        self.name    = name
+        self.doc     = doc
+        self.labels  = labels
+        self.buckets = tuple(buckets)
+        self._series: dict[tuple, list] = {}   # значения меток → [counts..., sum, count]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *label_values: str) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.setdefault(label_values, [0] * (len(self.buckets) + 2))
+            if i < len(self.buckets):
+                s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for values, s in sorted(series.items()):
+            base = [f'{l}="{v}"' for l, v in zip(self.labels, values)]
+            acc = 0
+            for le, n in zip(self.buckets, s):
+                acc += n
+                tags = ",".join(base + [f'le="{le}"'])
+                out.append(f"{self.name}_bucket{{{tags}}} {acc}")
+            tags = ",".join(base + ['le="+Inf"'])
+            out.append(f"{self.name}_bucket{{{tags}}} {s[-1]}")
+            tag = "{" + ",".join(base) + "}" if base else ""
+            out.append(f"{self.name}_sum{tag} {s[-2]}")
+            out.append(f"{self.name}_count{tag} {s[-1]}")
+        return out
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        self.name   = name
+        self.doc    = doc
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *label_values: str, value: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for vals, v in sorted(values.items()):
+            tag = "{" + ",".join(f'{l}="{x}"' for l, x in zip(self.labels, vals)) + "}" if vals else ""
+            out.append(f"{self.name}{tag} {v}")
+        return out
+
+REGISTRY: list = []
+
+STAGE_SECONDS  = Histogram("rag_stage_seconds", "Duration of a RAG pipeline stage", ("stage",))
+LLM_TTFT       = Histogram("rag_llm_ttft_seconds", "Time from LLM request to first token", ("model",))
+LLM_TOKENS_S   = Histogram("rag_llm_tokens_per_second", "LLM generation speed", ("model",), RATE_BUCKETS)
+PROMPT_TOKENS  = Histogram("rag_llm_prompt_tokens", "Prompt tokens evaluated by the LLM", ("model",), TOKEN_BUCKETS)
+REQUESTS       = Counter("rag_requests_total", "Answered questions by outcome", ("outcome",))
+
+@contextmanager
+def timed(stage: str, trace: dict | None = None):
+    """
+    with timed("rerank"): ... — пишет длительность в rag_stage_seconds{stage}
+    и, если передан trace, в trace[stage] (для записи в лог взаимодействий).
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        STAGE_SECONDS.observe(dt, stage)
+        if trace is not None:
+            trace[stage] = round(dt, 4)
+
+def render() -> str:
+    return "\n".join(line for m in REGISTRY for line in m.render()) + "\n"
+
+async def start_server(host: str = "127.0.0.1", port: int = 9108):
+    """
+    GET /metrics в формате Prometheus на event loop бота. Возвращает runner для cleanup().
+    """
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    return runner
+
+class InteractionLog:
+    """
+    Лог взаимодействий в JSONL: запись кладётся в очередь, фоновый поток
+    пишет пачками и держит файл открытым — запрос не ждёт диска.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, max_batch: int = 256):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def write(self, record: dict) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="interaction-log", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+        self._queue.put(record)
+
+    def _run(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                batch = [self._queue.get()]
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                    except queue.Empty:
+                        break
+                stop = None in batch
+                f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in batch if r is not None)
+                f.flush()
+                if stop:
+                    return
+
+    def close(self) -> None:
+        """
+        Дописать всё из очереди и остановить поток.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
@@ -2,16 +2,47 @@
 
 import os
 import json
+import time
+import asyncio
+import logging
+from typing import AsyncIterator
+
+import yaml
+import aiohttp
 import requests
 from dotenv import load_dotenv
 
+from balancer import Balancer, Backend
+
 # грузим .env из корня проекта
 ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 load_dotenv(os.path.join(ROOT, ".env"))
 
-OLLAMA_URL    = os.getenv("OLLAMA_URL", "http://127.0.0.1:11434").rstrip("/")
+logger = logging.getLogger("model")
+
+with open(os.path.join(ROOT, "config.yaml"), encoding="utf-8") as f:
+    LLM_CFG = yaml.safe_load(f).get("llm", {})
+
+# OLLAMA_URL может содержать несколько серверов через запятую
+OLLAMA_URLS   = [u.strip().rstrip("/") for u in os.getenv("OLLAMA_URL", "http://127.0.0.1:11434").split(",") if u.strip()]
 DEFAULT_MODEL = os.getenv("OLLAMA_MODEL", "mistral")
 
+POOL_SIZE  = LLM_CFG.get("pool_size", 8)
+TIMEOUT    = LLM_CFG.get("timeout", 60)
+MODELS     = LLM_CFG.get("models", ["deepseek", "mistral", "llama3"])
+KEEP_ALIVE = LLM_CFG.get("keep_alive", "30m")
+RESIDENT   = set(LLM_CFG.get("resident", []))   # эти модели Ollama не выгружает (keep_alive=-1)
+NUM_CTX    = LLM_CFG.get("num_ctx", 4096)
+RETRIES    = LLM_CFG.get("retries", 2)          # повторов до первого токена
+BACKOFF    = LLM_CFG.get("retry_backoff", 0.5)  # сек., удваивается с каждой попыткой
+
+balancer = Balancer(
+    OLLAMA_URLS,
+    fail_threshold = LLM_CFG.get("fail_threshold", 2),
+    cooldown       = LLM_CFG.get("unhealthy_cooldown", 5),
+    probe_interval = LLM_CFG.get("probe_interval", 10),
+)
+
 # Глобальная переменная для текущей модели
 CURRENT_MODEL = DEFAULT_MODEL
 
@@ -20,34 +51,270 @@ def set_model(name: str) -> None:
     Сменить модель на лету: deepseek, mistral или llama3
     """
     global CURRENT_MODEL
-    if name not in ("deepseek", "mistral", "llama3"):
-        raise ValueError(f"Unsupported model '{name}'. Valid: deepseek, mistral, llama3.")
+    if name not in MODELS:
+        raise ValueError(f"Unsupported model '{name}'. Valid: {', '.join(MODELS)}.")
     CURRENT_MODEL = name
 
-def generate_answer(prompt: str) -> str:
+def keep_alive(name: str):
+    return -1 if name in RESIDENT else KEEP_ALIVE
+
+def chat_payload(prompt: str, system: str = "", name: str | None = None,
+                 stream: bool = True, **options) -> dict:
     """
-    Отправляем prompt в Ollama через /api/generate с потоковой выдачей
+    Запрос к /api/chat. Инструкция идёт отдельным system-сообщением и всегда
+    одинакова, поэтому Ollama переиспользует её KV-кэш между запросами
+    и нужно прогнать через модель только контекст и вопрос.
     """
-    url = f"{OLLAMA_URL}/api/generate"
-    payload = {
-        "model":  CURRENT_MODEL,
-        "prompt": prompt,
-        "stream": True,
-        "temperature": 0.1,
-        # "max_tokens": 512
+    name = name or CURRENT_MODEL
+    messages = [{"role": "system", "content": system}] if system else []
+    messages.append({"role": "user", "content": prompt})
+    return {
+        "model":      name,
+        "messages":   messages,
+        "stream":     stream,
+        "keep_alive": keep_alive(name),
+        "options":    {"temperature": 0.1, "num_ctx": NUM_CTX, **options},
     }
-    resp = requests.post(url, json=payload, stream=True, timeout=60)
-    resp.raise_for_status()
 
-    answer = ""
-    for line in resp.iter_lines():
-        if not line:
-            continue
+def llm_stats(data: dict, stats: dict | None) -> None:
+    """
+    Счётчики Ollama из финальной строки ответа (done=true): токены промта и ответа, длительности в нс.
+    """
+    if stats is None:
+        return
+    for k in ("prompt_eval_count", "prompt_eval_duration", "eval_count", "eval_duration",
+              "load_duration", "total_duration"):
+        if k in data:
+            stats[k] = data[k]
+
+def generate_answer(prompt: str, system: str = "", stats: dict | None = None) -> str:
+    """
+    Отправляем prompt в Ollama через /api/chat с потоковой выдачей.
+    stats (если передан) заполняется ttft, backend и счётчиками Ollama.
+    """
+    payload = chat_payload(prompt, system)
+    tried: set[str] = set()
+    t0 = time.monotonic()
+    for attempt in range(RETRIES + 1):
+        b = balancer.pick(payload["model"], tried)
+        b.acquire()
+        try:
+            resp = requests.post(f"{b.url}/api/chat", json=payload, stream=True, timeout=(10, TIMEOUT))
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+            break
+        except requests.RequestException as e:
+            b.release()
+            balancer.mark_failed(b, e)
+            tried.add(b.url)
+            if attempt == RETRIES:
+                raise
+            time.sleep(BACKOFF * 2 ** attempt)
+
+    parts = []
+    try:
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            if not line:
+                continue
+            try:
+                data = json.loads(line.decode("utf-8"))
+            except json.JSONDecodeError:
+                continue
+            part = data.get("message", {}).get("content", "")
+            if part and not parts and stats is not None:
+                stats["ttft"] = time.monotonic() - t0
+            parts.append(part)
+            if data.get("done"):
+                llm_stats(data, stats)
+    finally:
+        b.release()
+    if stats is not None:
+        stats["backend"] = b.url
+
+    balancer.mark_ok(b, payload["model"])
+    return "".join(parts).strip()
+
+# ——— Async-клиент на постоянном пуле соединений ————————————————————
+_session: aiohttp.ClientSession | None = None
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Одна aiohttp-сессия на процесс: TCP-соединения к Ollama переиспользуются.
+    """
+    global _session
+    if _session is None or _session.closed:
+        conn = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=60)
+        # total=None: длинная генерация не должна обрываться, ограничиваем паузы между токенами
+        to   = aiohttp.ClientTimeout(total=None, connect=10, sock_read=TIMEOUT)
+        _session = aiohttp.ClientSession(connector=conn, timeout=to)
+    return _session
+
+async def start_balancer() -> None:
+    """
+    Первичная проверка серверов и фоновый health-check (нужен запущенный event loop).
+    """
+    await balancer.probe_all(get_session())
+    balancer.start(get_session)
+
+async def close_session() -> None:
+    global _session
+    await balancer.stop()
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+class RetryableStatus(aiohttp.ClientError):
+    pass
+
+async def stream_answer(prompt: str, system: str = "", stats: dict | None = None) -> AsyncIterator[str]:
+    """
+    Асинхронный итератор по токенам из /api/chat (stream=True).
+    Запрос уходит на наименее загруженный здоровый сервер; ошибки соединения
+    и 5xx повторяются на другом сервере — но только пока не отдан первый токен,
+    иначе пользователь получил бы ответ с повтором.
+    stats — как в generate_answer, плюс duration: время работы самого генератора
+    без пауз на yield (правки сообщения в Telegram и т.п. в него не входят) —
+    запасной вариант, если Ollama не прислала total_duration.
+    """
+    payload = chat_payload(prompt, system)
+    tried: set[str] = set()
+    t0 = time.monotonic()
+    paused = 0.0
+    for attempt in range(RETRIES + 1):
+        b = balancer.pick(payload["model"], tried)
+        started, tokens, t_first = False, 0, 0.0
+        b.acquire()
         try:
-            data = json.loads(line.decode("utf-8"))
-            part = data.get("response", "")
-            answer += part
-        except json.JSONDecodeError:
-            continue
+            async with get_session().post(f"{b.url}/api/chat", json=payload) as resp:
+                if resp.status >= 500:
+                    raise RetryableStatus(f"{b.url}: HTTP {resp.status}")
+                resp.raise_for_status()
+                # Ollama отдаёт NDJSON: одна JSON-строка на токен
+                async for line in resp.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        data = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    part = data.get("message", {}).get("content", "")
+                    if part:
+                        if not started:
+                            started, t_first = True, time.monotonic()
+                            if stats is not None:
+                                stats["ttft"] = t_first - t0
+                        tokens += 1
+                        t_yield = time.monotonic()
+                        yield part
+                        paused += time.monotonic() - t_yield
+                    if data.get("done"):
+                        llm_stats(data, stats)
+                        break
+            if stats is not None:
+                stats["backend"] = b.url
+            balancer.mark_ok(b, payload["model"], tokens, time.monotonic() - t_first if started else 0.0)
+            return
+        except aiohttp.ClientResponseError:
+            raise  # 4xx: модель не найдена и т.п., повтор не поможет
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            balancer.mark_failed(b, e)
+            if started or attempt == RETRIES:
+                raise
+            tried.add(b.url)
+            logger.warning(f"Ollama {b.url} failed ({e!r}), retry {attempt + 1}/{RETRIES}")
+            await asyncio.sleep(BACKOFF * 2 ** attempt)
+        finally:
+            b.release()
+            if stats is not None:
+                stats["duration"] = time.monotonic() - t0 - paused
+
+# ——— Резидентность моделей в Ollama ————————————————————————————————
+# model -> {"state": cold|loading|warm|evicted, "load_s", "warmed_at", "backends"}
+_states: dict[str, dict] = {name: {"state": "cold"} for name in MODELS}
+_warm_locks: dict[str, asyncio.Lock] = {}
+
+async def warm_backend(b: Backend, name: str, system: str) -> float:
+    payload = chat_payload(".", system, name, stream=False, num_predict=1)
+    try:
+        async with get_session().post(f"{b.url}/api/chat", json=payload) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        balancer.mark_failed(b, e)
+        raise
+    balancer.mark_ok(b, name)
+    return data.get("load_duration", 0) / 1e9
+
+async def warmup(name: str, system: str = "") -> float:
+    """
+    Загружает модель на всех здоровых серверах и прогоняет через неё system-префикс
+    (num_predict=1), чтобы первый настоящий вопрос не ждал ни загрузки весов,
+    ни prefill инструкции. Возвращает время прогрева в секундах.
+    """
+    lock = _warm_locks.setdefault(name, asyncio.Lock())
+    async with lock:
+        st = _states.setdefault(name, {"state": "cold"})
+        st["state"] = "loading"
+        t0 = time.monotonic()
+        targets = [b for b in balancer.backends if b.healthy] or balancer.backends
+        results = await asyncio.gather(*(warm_backend(b, name, system) for b in targets), return_exceptions=True)
+        ok = [(b, r) for b, r in zip(targets, results) if not isinstance(r, BaseException)]
+        for b, r in zip(targets, results):
+            if isinstance(r, BaseException):
+                logger.warning(f"Warmup of {name} on {b.url} failed: {r!r}")
+        if not ok:
+            st["state"] = "cold"
+            raise next(r for r in results if isinstance(r, BaseException))
+        took = time.monotonic() - t0
+        st.update(
+            state     = "warm",
+            load_s    = max(r for _, r in ok),
+            warmed_at = time.time(),
+            backends  = [b.url for b, _ in ok],
+        )
+        logger.info(f"Model {name} warm on {len(ok)}/{len(targets)} backends in {took:.1f}s "
+                    f"(load {st['load_s']:.1f}s, keep_alive={keep_alive(name)})")
+        return took
+
+async def ensure_warm(name: str, system: str = "") -> None:
+    """
+    Прогрев перед переключением, если модель не загружена хотя бы на одном
+    здоровом сервере. Загруженность — по свежему /api/ps, а не по _states:
+    после keep_alive Ollama выгружает модель сама.
+    """
+    await refresh_state()
+    healthy = [b for b in balancer.backends if b.healthy]
+    if not healthy or not all(b.has_model(name) for b in healthy):
+        await warmup(name, system)
+
+async def warmup_all(system: str = "", models: list[str] | None = None) -> None:
+    """
+    Прогрев всех разрешённых моделей по очереди (параллельная загрузка
+    только толкается за память). Текущая модель — первой.
+    """
+    order = sorted(models or MODELS, key=lambda m: m != CURRENT_MODEL)
+    for name in order:
+        try:
+            await warmup(name, system)
+        except Exception:
+            logger.exception(f"Warmup of {name} failed; first request to it may be slow")
+
+async def refresh_state() -> dict[str, dict]:
+    """
+    Сверяет состояние с /api/ps всех серверов: где модель реально загружена
+    и когда Ollama её выгрузит.
+    """
+    await balancer.probe_all(get_session())
+    for name, st in _states.items():
+        where = [b for b in balancer.backends if b.healthy and b.has_model(name)]
+        if where:
+            info = next(m for n, m in where[0].models.items() if n == name or n.startswith(name + ":"))
+            st.update(state="warm", backends=[b.url for b in where], expires_at=info.get("expires_at"))
+        elif st.get("state") == "warm":
+            st.update(state="evicted", backends=[])
+    return model_state()
 
-    return answer.strip()
+def model_state() -> dict[str, dict]:
+    return {name: dict(st) for name, st in _states.items()}
@@ -2,41 +2,100 @@ import os
 from datetime import datetime
 from typing import List
 
-from retriever import retrieve
-from model     import generate_answer
+import yaml
 
-def log_interaction(question: str, answer: str) -> None:
+import model
+from model        import generate_answer
+from answer_cache import AnswerCache
+from context      import build_context
+from metrics      import timed, InteractionLog, REQUESTS, LLM_TTFT, LLM_TOKENS_S, PROMPT_TOKENS
+
+NOT_SURE = "Hmm, I’m not sure."
+# Берём, например, первые 10 релевантных фрагментов
+TOP_K = 10
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+with open(os.path.join(ROOT, "config.yaml"), encoding="utf-8") as f:
+    _cfg = yaml.safe_load(f)
+
+# Поиск в этом процессе (индекс и модели грузятся лениво) или через общий
+# retrieval-сервис, если задан retrieve.service_url — интерфейс одинаковый
+if _cfg["retrieve"].get("service_url"):
+    import retrieval_client as search
+else:
+    import retriever as search
+CACHE_CFG = _cfg.get("cache", {})
+CTX_CFG   = _cfg.get("context", {})
+MET_CFG   = _cfg.get("metrics", {})
+
+answer_cache = AnswerCache(
+    search.index_version,
+    max_size  = CACHE_CFG.get("max_size", 1000),
+    ttl       = CACHE_CFG.get("ttl", 86400),
+    threshold = CACHE_CFG.get("similarity_threshold", 0.95),
+) if CACHE_CFG.get("enabled", True) else None
+
+interactions = InteractionLog(
+    os.path.join(ROOT, MET_CFG.get("interactions_log", "logs/interactions.jsonl")),
+    flush_interval = MET_CFG.get("log_flush_interval", 1.0),
+)
+
+def log_interaction(question: str, answer: str, trace: dict | None = None) -> None:
     """
-    Логируем запрос и ответ в файл logs/interactions.log
+    Логируем запрос, ответ и тайминги стадий в logs/interactions.jsonl
+    (запись в фоновом потоке, пачками).
     """
-    os.makedirs("logs", exist_ok=True)
-    with open("logs/interactions.log", "a", encoding="utf-8") as f:
-        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        f.write(f"[{ts}]\nQ: {question}\nA: {answer}\n\n")
+    interactions.write({
+        "ts":       datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "model":    model.CURRENT_MODEL,
+        "question": question,
+        "answer":   answer,
+        **(trace or {}),
+    })
+
+def record_llm(trace: dict, stats: dict) -> None:
+    """
+    TTFT, скорость генерации и размер промта из ответа Ollama — в гистограммы и trace.
+    """
+    name = model.CURRENT_MODEL
+    if "ttft" in stats:
+        LLM_TTFT.observe(stats["ttft"], name)
+        trace["llm_ttft"] = round(stats["ttft"], 4)
+    if stats.get("eval_duration"):
+        tps = stats["eval_count"] / (stats["eval_duration"] / 1e9)
+        LLM_TOKENS_S.observe(tps, name)
+        trace["tokens_per_s"] = round(tps, 1)
+    if "prompt_eval_count" in stats:
+        PROMPT_TOKENS.observe(stats["prompt_eval_count"], name)
+        trace["prompt_tokens"] = stats["prompt_eval_count"]
+    for k in ("eval_count", "backend"):
+        if k in stats:
+            trace[k] = stats[k]
+
+# Инструкция (объединённый промт) — неизменный префикс каждого запроса,
+# отправляется system-сообщением, чтобы Ollama держала её KV-кэш
+SYSTEM_PROMPT = (
+    "You are an expert consultant and problem-solver, tasked with answering any question about Astana IT University. "
+    "Generate a comprehensive and informative answer of 80 words or less for the given question based solely on the provided search results (URL and content). "
+    "You must only use information from those results. Use an unbiased, journalistic tone. Combine search results into a coherent answer without repeating text. "
+    "Use bullet points for readability. Cite search results using [${number}] notation immediately after the sentence or paragraph that references them. "
+    "If different results refer to different entities with the same name, write separate answers for each. "
+    "If there is no relevant information in the context, just say “Hmm, I’m not sure.” Anything between the following `<context>` tags is retrieved from a knowledge bank, not part of the conversation:\n\n"
+)
 
 def build_prompt(context_chunks: List[dict], question: str) -> str:
     """
-    Формирует единый промт, включающий:
-    1) инструкцию (объединённый промт),
-    2) блок <context> с нумерованными фрагментами,
-    3) сам вопрос.
+    Формирует пользовательскую часть промта (инструкция — SYSTEM_PROMPT):
+    1) блок <context> с нумерованными фрагментами,
+    2) сам вопрос.
     Каждый фрагмент нумеруется начиная с 1 в том порядке,
     в котором они передаются в context_chunks.
     """
-    # Инструкция (объединённый промт)
-    instruction = (
-        "You are an expert consultant and problem-solver, tasked with answering any question about Astana IT University. "
-        "Generate a comprehensive and informative answer of 80 words or less for the given question based solely on the provided search results (URL and content). "
-        "You must only use information from those results. Use an unbiased, journalistic tone. Combine search results into a coherent answer without repeating text. "
-        "Use bullet points for readability. Cite search results using [${number}] notation immediately after the sentence or paragraph that references them. "
-        "If different results refer to different entities with the same name, write separate answers for each. "
-        "If there is no relevant information in the context, just say “Hmm, I’m not sure.” Anything between the following `<context>` tags is retrieved from a knowledge bank, not part of the conversation:\n\n"
-    )
-
     context_lines = ["<context>"]
     for idx, chunk in enumerate(context_chunks, start=1):
         # Нумеруем каждый фрагмент
-        url   = chunk.get("page_url", "")
+        # фрагмент, встречающийся на нескольких страницах, цитируется со всеми URL
+        url   = ", ".join(chunk.get("sources") or [chunk.get("page_url", "")])
         text  = chunk.get("text", "").strip().replace("\n", " ")
         # Добавляем в виде: "1. URL: … Text: …"
         context_lines.append(f"{idx}. URL: {url}\n   Text: {text}\n")
@@ -44,12 +103,54 @@ def build_prompt(context_chunks: List[dict], question: str) -> str:
 
     # Собираем финальный промт
     prompt = (
-        instruction
-        + "\n".join(context_lines)
+        "\n".join(context_lines)
         + f"Question: {question}\nAnswer:"
     )
     return prompt
 
+def cache_lookup(question: str, trace: dict | None = None):
+    """
+    Эмбеддинг вопроса + поиск в кэше ответов.
+    Возвращает (ответ или None, вектор вопроса) — вектор переиспользуется в retrieve.
+    Для запросов из ключевых слов (лексический fast path) эмбеддинг не считается:
+    только точное совпадение в кэше, вектор None.
+    """
+    fast = search.lexical_fast_path(question)
+    with timed("cache", trace):
+        if answer_cache is None:
+            return None, None if fast else search.embed_query(question)
+        # точное совпадение не требует эмбеддинга
+        cached = answer_cache.get_exact(model.CURRENT_MODEL, question)
+        if cached is not None or fast:
+            return cached, None
+        qv = search.embed_query(question)
+        return answer_cache.get_similar(model.CURRENT_MODEL, question, qv), qv
+
+def cache_store(question: str, qv, answer: str) -> None:
+    if answer_cache is not None:
+        answer_cache.put(model.CURRENT_MODEL, question, qv, answer)
+
+def prepare_prompt(question: str, qv=None, trace: dict | None = None) -> str | None:
+    """
+    CPU-часть пайплайна: retrieve + build_prompt.
+    Возвращает None, если ничего релевантного не нашлось.
+    """
+    with timed("retrieve", trace):
+        retrieved = search.retrieve(question, qv)  # возвращает list[dict], где ключ "text" и остальные метаданные
+    if not retrieved:
+        return None
+
+    # Оставляем максимум TOP_K штук, склеиваем соседние и укладываем в бюджет токенов
+    with timed("context", trace):
+        context_chunks = build_context(
+            retrieved[:TOP_K],
+            budget          = CTX_CFG.get("token_budget", 2000),
+            dedup_threshold = CTX_CFG.get("dedup_threshold", 0.8),
+        )
+    # Тексты в запросе нужны именно из поля "text", остальное — для цитирования
+    with timed("prompt", trace):
+        return build_prompt(context_chunks, question)
+
 def answer_question(question: str) -> str:
     """
     1) Получает топ-K фрагментов из реликванта (retrieve),
@@ -58,19 +159,25 @@ def answer_question(question: str) -> str:
     4) Отправляет его в модель (generate_answer),
     5) Логирует взаимодействие и возвращает ответ.
     """
-    # Берём, например, первые 10 релевантных фрагментов
-    top_k = 10
-    retrieved = retrieve(question)  # возвращает list[dict], где ключ "text" и остальные метаданные
-    if not retrieved:
-        return "Hmm, I’m not sure."
+    trace: dict = {}
+    cached, qv = cache_lookup(question, trace)
+    if cached is not None:
+        REQUESTS.inc("cache")
+        log_interaction(question, cached, trace)
+        return cached
 
-    # Оставляем максимум top_k штук
-    context_chunks = retrieved[:top_k]
-    # Тексты в запросе нужны именно из поля "text", остальное — для цитирования
-    ctx_prompt = build_prompt(context_chunks, question)
+    ctx_prompt = prepare_prompt(question, qv, trace)
+    if ctx_prompt is None:
+        REQUESTS.inc("not_found")
+        return NOT_SURE
 
     # Получаем ответ от модели (стриминг внутри)
-    answer = generate_answer(ctx_prompt)
+    stats: dict = {}
+    with timed("llm", trace):
+        answer = generate_answer(ctx_prompt, SYSTEM_PROMPT, stats)
+    record_llm(trace, stats)
 
-    log_interaction(question, answer)
-    return answer
\ No newline at end of file
+    cache_store(question, qv, answer)
+    REQUESTS.inc("answered")
+    log_interaction(question, answer, trace)
+    return answer
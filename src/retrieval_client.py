@@ -0,0 +1,125 @@
+# src/retrieval_client.py
+#
+# Клиент retrieval-сервиса (src/retrieval_service.py) с тем же интерфейсом,
+# что у retriever: embed_query / retrieve / index_version / reload_index.
+# Не импортирует ни faiss, ни sentence-transformers — процесс бота с ним
+# не держит своих копий индекса и моделей.
+
+import os
+import json
+import base64
+import socket
+import logging
+import threading
+import http.client
+from urllib.parse import urlparse
+
+import numpy as np
+import yaml
+
+from lexical import is_keyword_query
+
+def load_config():
+    src  = os.path.dirname(os.path.abspath(__file__))
+    root = os.path.dirname(src)
+    with open(os.path.join(root, "config.yaml"), encoding="utf-8") as f:
+        return yaml.safe_load(f)
+
+def project_root():
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+logger = logging.getLogger("retrieval_client")
+
+cfg  = load_config()
+ROOT = project_root()
+
+SERVICE_URL = cfg["retrieve"].get("service_url")   # http://127.0.0.1:8765 или unix:/path/to.sock
+TIMEOUT     = cfg["retrieve"].get("service_timeout", 30)
+VER_PATH    = os.path.join(ROOT, cfg["data"]["faiss_index_dir"], "VERSION")
+FAST_PATH   = (cfg["retrieve"].get("mode", "dense") == "hybrid"
+               and cfg["retrieve"].get("lexical_fast_path", True))
+FAST_MAX_WORDS = cfg["retrieve"].get("fast_path_max_words", 3)
+
+def pack(v: np.ndarray) -> str:
+    return base64.b64encode(np.ascontiguousarray(v, dtype="<f4").tobytes()).decode("ascii")
+
+def unpack(s: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(s), dtype="<f4").reshape(1, -1)
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+def connect(url: str, timeout: float = TIMEOUT) -> http.client.HTTPConnection:
+    u = urlparse(url)
+    if u.scheme == "unix":
+        return UnixHTTPConnection(u.path, timeout)
+    return http.client.HTTPConnection(u.hostname, u.port or 80, timeout=timeout)
+
+# keep-alive соединение на поток: вызовы идут из CPU-пула async_rag
+_local = threading.local()
+
+def call(path: str, payload: dict | None = None):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else None
+    for attempt in (0, 1):
+        conn = getattr(_local, "conn", None)
+        if conn is None:
+            conn = _local.conn = connect(SERVICE_URL)
+        try:
+            conn.request("POST" if body is not None else "GET", path, body=body,
+                         headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            data = resp.read()
+        except (ConnectionRefusedError, ConnectionResetError, BrokenPipeError):
+            # сервис перезапустился или закрыл простаивавшее соединение — одна попытка заново
+            # (RemoteDisconnected — тоже ConnectionResetError)
+            conn.close()
+            _local.conn = None
+            if attempt:
+                raise
+            continue
+        except (OSError, http.client.HTTPException):
+            # таймаут и прочее — сразу наверх: повтор стоил бы ещё одного TIMEOUT
+            conn.close()
+            _local.conn = None
+            raise
+        if resp.status != 200:
+            raise RuntimeError(f"Retrieval service {path}: HTTP {resp.status} {data[:200]!r}")
+        return json.loads(data)
+
+def index_version() -> str | None:
+    # сервис и бот работают с одним data/ — VERSION читаем сами, без запроса
+    try:
+        with open(VER_PATH, encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def lexical_fast_path(query: str) -> bool:
+    return FAST_PATH and is_keyword_query(query, FAST_MAX_WORDS)
+
+def embed_query(query: str) -> np.ndarray:
+    return unpack(call("/embed", {"query": query})["qv"])
+
+def retrieve(query: str, qv=None, filters: dict | None = None) -> list[dict]:
+    payload = {"query": query, "filters": filters}
+    if qv is not None:
+        payload["qv"] = pack(qv)
+    return call("/retrieve", payload)["docs"]
+
+def reload_index(force: bool = False) -> bool:
+    return call("/reload", {"force": force})["reloaded"]
+
+def start_watcher(interval: float = 0) -> None:
+    # за новыми версиями индекса следит сам сервис
+    pass
+
+def init() -> None:
+    info = call("/health")
+    logger.info(f"Retrieval service {SERVICE_URL}: index {info.get('version')}")
@@ -0,0 +1,353 @@
+# src/retrieval_eval.py
+#
+# Оценка качества поиска и перебор настроек retrieve:
+#   python -m src.retrieval_eval [--labels test/test.txt ...] [--top-k 5 10 15] [--rerank-k 3 5]
+#                               [--factory Flat HNSW32] [--mode dense hybrid] [--fused-k 5 10] [--chunks 500:50 300:30] [--out eval.json]
+# Разметка — TSV с колонкой «Вопрос» и, желательно, «URL» (правильные страницы через пробел или |).
+# Без колонки «URL» правильной считается страница чанка, ближайшего к эталонному «Ответ» (silver-разметка).
+# Метрики на уровне страниц: recall@k, MRR, nDCG@k, где k — сколько результатов уходит в промт.
+# Между точками сетки переиспользуются эмбеддинги вопросов, чанки и их эмбеддинги
+# (data/eval_cache/chunks-<size>-<overlap>/), собранные индексы и оценки reranker'а.
+
+import os
+import re
+import csv
+import json
+import time
+import hashlib
+import argparse
+import logging
+
+import numpy as np
+import faiss
+
+import indexer
+from indexer import build_full, cfg, ROOT, emb_path, meta_path, METRIC
+from lexical import BM25Index, write_bm25, rrf
+from vectors import VectorFile
+
+logger = logging.getLogger("retrieval_eval")
+
+EVAL_CFG  = cfg.get("eval", {})
+CACHE_DIR = os.path.join(ROOT, EVAL_CFG.get("cache_dir", "data/eval_cache"))
+CORPUS    = os.path.join(ROOT, cfg["data"].get("corpus_dir", "data/corpus"))
+LAT_QUERIES = 100   # запросов для замера задержки одиночного поиска
+RRF_K       = cfg["retrieve"].get("rrf_k", 60)
+LEX_K       = cfg["retrieve"].get("lexical_top_k", cfg["retrieve"]["top_k"])
+
+def load_labels(paths: list[str]) -> tuple[list[str], list[set[str]], list[str]]:
+    """
+    (вопросы, правильные URL или пустое множество, эталонные ответы).
+    """
+    qs, gold, answers = [], [], []
+    for p in paths:
+        with open(p, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f, delimiter="\t"):
+                q = (row.get("Вопрос") or "").strip()
+                if not q:
+                    continue
+                qs.append(q)
+                gold.append({u for u in re.split(r"[\s|]+", row.get("URL") or "") if u})
+                answers.append((row.get("Ответ") or "").strip())
+    return qs, gold, answers
+
+def load_meta(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def stamp(path: str) -> str:
+    st = os.stat(path)
+    return f"{st.st_size}-{int(st.st_mtime)}"
+
+# ——— Метрики ———————————————————————————————————————————————————————
+
+def page_metrics(P: np.ndarray, G: np.ndarray, k: int) -> dict:
+    """
+    P — (nq, K) коды страниц результатов в порядке ранга (-1 — пусто),
+    G — (nq, n_pages) bool, правильные страницы. Повторы страницы в выдаче
+    не считаются: ранг — позиция среди уникальных страниц.
+    """
+    nq, K = P.shape
+    # первое вхождение страницы в строке: сортировка + сравнение с соседом
+    order = np.argsort(P, axis=1, kind="stable")
+    Ps    = np.take_along_axis(P, order, axis=1)
+    dup_s = np.zeros_like(Ps, dtype=bool)
+    dup_s[:, 1:] = Ps[:, 1:] == Ps[:, :-1]
+    dup = np.empty_like(dup_s)
+    np.put_along_axis(dup, order, dup_s, axis=1)
+    first = ~dup & (P >= 0)
+
+    rank = np.cumsum(first, axis=1) - 1                       # ранг среди уникальных страниц
+    rel  = first & G[np.arange(nq)[:, None], np.maximum(P, 0)] & (rank < k)
+
+    n_gold = G.sum(axis=1)
+    valid  = n_gold > 0
+    recall = rel.sum(axis=1) / np.maximum(n_gold, 1)
+    rr     = np.where(rel, 1.0 / (rank + 1), 0.0).max(axis=1, initial=0.0)
+    gains  = np.where(rel, 1.0 / np.log2(rank + 2), 0.0).sum(axis=1)
+    ideal  = np.cumsum(1.0 / np.log2(np.arange(k) + 2))[np.minimum(n_gold, k) - 1]
+    ndcg   = np.where(valid, gains / np.where(valid, ideal, 1.0), 0.0)
+    return {
+        f"recall@{k}": float(recall[valid].mean()) if valid.any() else 0.0,
+        "mrr":         float(rr[valid].mean()) if valid.any() else 0.0,
+        f"ndcg@{k}":   float(ndcg[valid].mean()) if valid.any() else 0.0,
+    }
+
+# ——— Артефакты (с кэшем между точками сетки) ———————————————————————————
+
+class Artifacts:
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self._model = None
+        self._ce: dict[str, object] = {}
+
+    def model(self):
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+            self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def cross_encoder(self, name: str):
+        if name not in self._ce:
+            from sentence_transformers import CrossEncoder
+            self._ce[name] = CrossEncoder(name)
+        return self._ce[name]
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        # все вопросы одним батчем
+        return np.ascontiguousarray(self.model().encode(texts, batch_size=64, normalize_embeddings=True), dtype="float32")
+
+    def chunks(self, size: int, overlap: int) -> tuple[str, list[dict]]:
+        """
+        Путь к эмбеддингам и метаданные чанков для заданного чанкинга.
+        Текущие настройки — готовые data/embeddings, иные — перечанкованный корпус в кэше.
+        """
+        if (size, overlap) == (cfg["ingest"]["chunk_size"], cfg["ingest"]["chunk_overlap"]):
+            return emb_path, load_meta(meta_path)
+
+        out = os.path.join(CACHE_DIR, f"chunks-{size}-{overlap}")
+        emb, meta = os.path.join(out, "embeddings.npy"), os.path.join(out, "metadata.jsonl")
+        if os.path.exists(emb) and os.path.exists(meta):
+            return emb, load_meta(meta)
+
+        import ingest
+        from corpus import iter_pages
+        ingest.CHUNK_SZ, ingest.OVERLAP = size, overlap
+        if ingest.tokenizer is None:
+            ingest.init_parse_worker()
+        pages = list(iter_pages(CORPUS))
+        logger.info(f"Re-chunking {len(pages)} pages with size={size}, overlap={overlap}")
+        rows = []
+        for page, chunks in zip(pages, ingest.chunk_texts([p["main_text"] for p in pages], [p["md_text"] for p in pages])):
+            rows += [{"page_url": page["page_url"], **ch} for ch in chunks]
+        vecs = self.model().encode([r["text"] for r in rows], batch_size=cfg["embed"]["batch_size"],
+                                   normalize_embeddings=True, show_progress_bar=True)
+        os.makedirs(out, exist_ok=True)
+        np.save(emb, np.asarray(vecs, dtype="float32"))
+        with open(meta, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in rows)
+        return emb, rows
+
+    def index(self, emb_file: str, factory: str) -> faiss.Index:
+        """
+        Индекс по эмбеддингам; файл в кэше привязан к размеру/mtime эмбеддингов.
+        """
+        key  = hashlib.sha1(f"{emb_file}|{stamp(emb_file)}|{factory}".encode()).hexdigest()[:16]
+        path = os.path.join(CACHE_DIR, "indexes", f"{key}.faiss")
+        if os.path.exists(path):
+            idx = faiss.read_index(path)
+            indexer.set_nprobe(idx)
+            return idx
+        emb = VectorFile(emb_file)
+        idx = build_full(emb, np.arange(len(emb), dtype="int64"), factory)
+        emb.close()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        faiss.write_index(idx, path)
+        return idx
+
+    def bm25(self, emb_file: str, meta: list[dict]) -> BM25Index:
+        """
+        BM25 по тем же чанкам; uid = номер строки, как ID в индексах выше.
+        """
+        key  = hashlib.sha1(f"{emb_file}|{stamp(emb_file)}|bm25".encode()).hexdigest()[:16]
+        path = os.path.join(CACHE_DIR, "bm25", key)
+        if not os.path.exists(os.path.join(path, "stats.json")):
+            write_bm25(path, dict(enumerate(meta)))
+        r = cfg["retrieve"]
+        return BM25Index(path, r.get("bm25_k1", 1.2), r.get("bm25_b", 0.75))
+
+# ——— Перебор ————————————————————————————————————————————————————————
+
+def silver_gold(art: Artifacts, answers: list[str], emb_file: str, meta: list[dict]) -> list[set[str]]:
+    """
+    Правильная страница = страница чанка, ближайшего к эталонному ответу (точный поиск).
+    """
+    A = art.encode([a or " " for a in answers])
+    emb = VectorFile(emb_file)
+    flat = faiss.IndexFlat(emb.shape[1], METRIC)
+    for _, block in emb.iter_blocks(indexer.ADD_BLOCK, normalize=True):
+        flat.add(block)
+    emb.close()
+    I = flat.search(A, 1)[1]
+    return [{meta[i]["page_url"]} if a and i >= 0 else set() for a, i in zip(answers, I[:, 0])]
+
+def search_latency(idx: faiss.Index, Q: np.ndarray, k: int) -> float:
+    lat = []
+    for i in range(min(len(Q), LAT_QUERIES)):
+        t = time.perf_counter()
+        idx.search(Q[i:i + 1], k)
+        lat.append(time.perf_counter() - t)
+    return float(np.percentile(np.array(lat) * 1000, 50))
+
+def sweep(args) -> list[dict]:
+    art = Artifacts(cfg["embed"]["model_name"])
+    qs, gold, answers = load_labels(args.labels)
+    if not qs:
+        raise SystemExit("No labelled questions")
+    Q = art.encode(qs)
+    logger.info(f"{len(qs)} questions, {sum(bool(g) for g in gold)} with gold URLs")
+
+    # silver-разметка строится один раз, по текущему чанкингу
+    if not all(gold):
+        silver = silver_gold(art, answers, *art.chunks(cfg["ingest"]["chunk_size"], cfg["ingest"]["chunk_overlap"]))
+        gold = [g or s for g, s in zip(gold, silver)]
+
+    max_k = max(args.top_k)
+    results = []
+    for size, overlap in args.chunks:
+        emb_file, meta = art.chunks(size, overlap)
+        pages = {u: i for i, u in enumerate(sorted({m["page_url"] for m in meta}))}
+        page_of = np.array([pages[m["page_url"]] for m in meta], dtype="int64")
+        G = np.zeros((len(qs), len(pages)), dtype=bool)
+        for n, urls in enumerate(gold):
+            G[n, [pages[u] for u in urls if u in pages]] = True
+
+        for factory in args.factory:
+            idx = art.index(emb_file, factory)
+            # один поиск на максимальную глубину; меньшие top_k — срезы
+            t0 = time.perf_counter()
+            D, I = idx.search(Q, max_k)
+            batch_ms = (time.perf_counter() - t0) * 1000 / len(qs)
+            lat_ms = search_latency(idx, Q, max_k)
+
+            for mode in args.mode:
+                # варианты кандидатов для reranker'а: (top_k, fused_k, ID) — как в retriever:
+                # dense — top_k из FAISS; hybrid — top_k из FAISS + lexical_top_k из BM25,
+                # слияние RRF и срез fused_k
+                if mode == "hybrid":
+                    lex = art.bm25(emb_file, meta)
+                    t0 = time.perf_counter()
+                    lex_hits = [lex.search(q, LEX_K) for q in qs]
+                    search_ms = lat_ms + (time.perf_counter() - t0) * 1000 / len(qs)
+                    variants = []
+                    for top_k in args.top_k:
+                        for fused_k in args.fused_k:
+                            cand = np.full((len(qs), fused_k), -1, dtype="int64")
+                            for n in range(len(qs)):
+                                dense = [(int(i), 0.0) for i in I[n, :top_k] if i >= 0]
+                                fused = rrf([dense, lex_hits[n]], RRF_K)[:fused_k]
+                                cand[n, :len(fused)] = [u for u, _ in fused]
+                            variants.append((top_k, fused_k, cand))
+                else:
+                    search_ms = lat_ms
+                    variants = [(top_k, None, I[:, :top_k]) for top_k in args.top_k]
+
+                for ce in args.cross_encoder:
+                    ce_scores, pair_ms = None, 0.0
+                    if ce != "none":
+                        # одна оценка на пару (вопрос, чанк) для всех вариантов
+                        model = art.cross_encoder(ce)
+                        uniq = sorted({(n, int(i)) for _, _, cand in variants
+                                       for n, row in enumerate(cand) for i in row if i >= 0})
+                        t0 = time.perf_counter()
+                        flat = np.asarray(model.predict([(qs[n], meta[i]["text"]) for n, i in uniq],
+                                                        batch_size=64), dtype="float32")
+                        pair_ms = (time.perf_counter() - t0) * 1000 / max(len(uniq), 1)
+                        ce_scores = dict(zip(uniq, flat))
+
+                    for top_k, fused_k, cand in variants:
+                        n_cand = cand.shape[1]   # столько пар на вопрос уходит в reranker
+                        scores = None
+                        if ce_scores is not None:
+                            scores = np.array([[ce_scores[(n, int(i))] if i >= 0 else -np.inf for i in row]
+                                               for n, row in enumerate(cand)], dtype="float32")
+                        for rerank_k in (args.rerank_k if scores is not None else [n_cand]):
+                            if scores is not None:
+                                order = np.argsort(-scores, axis=1, kind="stable")[:, :rerank_k]
+                                final = np.take_along_axis(cand, order, axis=1)
+                            else:
+                                final = cand
+                            P = np.where(final >= 0, page_of[np.maximum(final, 0)], -1)
+                            k = final.shape[1]
+                            m = page_metrics(P, G, k)
+                            results.append({
+                                "chunks":    f"{size}:{overlap}",
+                                "factory":   factory,
+                                "mode":      mode,
+                                "reranker":  ce,
+                                "top_k":     top_k,
+                                "fused_k":   fused_k,
+                                "rerank_k":  rerank_k if scores is not None else None,
+                                "recall":    m[f"recall@{k}"],
+                                "mrr":       m["mrr"],
+                                "ndcg":      m[f"ndcg@{k}"],
+                                "search_ms": search_ms,
+                                "batch_ms":  batch_ms,
+                                "rerank_ms": pair_ms * n_cand,
+                                "ms":        search_ms + pair_ms * n_cand,
+                            })
+    return results
+
+def parse_chunks(values: list[str]) -> list[tuple[int, int]]:
+    out = []
+    for v in values:
+        size, _, overlap = v.partition(":")
+        out.append((int(size), int(overlap or cfg["ingest"]["chunk_overlap"])))
+    return out
+
+def main():
+    r = cfg["retrieve"]
+    ap = argparse.ArgumentParser(description="Retrieval quality (recall/MRR/nDCG) vs latency over a settings grid")
+    ap.add_argument("--labels",  nargs="+", default=[os.path.join(ROOT, "test", "test.txt")])
+    ap.add_argument("--top-k",   nargs="+", type=int, default=EVAL_CFG.get("top_k", [r["top_k"]]))
+    ap.add_argument("--rerank-k", nargs="+", type=int, default=EVAL_CFG.get("rerank_k", [r["rerank_k"]]))
+    ap.add_argument("--factory", nargs="+", default=EVAL_CFG.get("factory", [cfg["index"]["factory_string"]]))
+    ap.add_argument("--mode",    nargs="+", choices=["dense", "hybrid"],
+                    default=EVAL_CFG.get("mode", [r.get("mode", "dense")]))
+    ap.add_argument("--fused-k", nargs="+", type=int, default=EVAL_CFG.get("fused_k", [r.get("fused_k", r["top_k"])]),
+                    help="кандидатов после RRF (только hybrid)")
+    ap.add_argument("--cross-encoder", nargs="+",
+                    default=EVAL_CFG.get("cross_encoder", [r.get("cross_encoder_model") or "none"]),
+                    help="имена моделей CrossEncoder или none")
+    ap.add_argument("--chunks",  nargs="+",
+                    default=EVAL_CFG.get("chunks", [f"{cfg['ingest']['chunk_size']}:{cfg['ingest']['chunk_overlap']}"]),
+                    help="chunk_size:chunk_overlap")
+    ap.add_argument("--tolerance", type=float, default=EVAL_CFG.get("tolerance", 0.01),
+                    help="допустимая потеря nDCG относительно лучшей конфигурации")
+    ap.add_argument("--out", help="сохранить все точки сетки в JSON")
+    args = ap.parse_args()
+    args.chunks = parse_chunks([str(c) for c in args.chunks])
+
+    results = sweep(args)
+    results.sort(key=lambda x: x["ms"])
+
+    print(f"\n{'chunks':<9}{'factory':<18}{'mode':<8}{'reranker':<22}{'top_k':>6}{'fus_k':>6}{'rr_k':>6}"
+          f"{'recall':>8}{'mrr':>8}{'ndcg':>8}{'ms/q':>9}")
+    for x in results:
+        print(f"{x['chunks']:<9}{x['factory'][:17]:<18}{x['mode']:<8}{x['reranker'][-21:]:<22}{x['top_k']:>6}{x['fused_k'] or '-':>6}"
+              f"{x['rerank_k'] or '-':>6}{x['recall']:>8.3f}{x['mrr']:>8.3f}{x['ndcg']:>8.3f}{x['ms']:>9.2f}")
+
+    best = max(x["ndcg"] for x in results)
+    cheapest = next(x for x in results if x["ndcg"] >= best - args.tolerance)
+    print(f"\nBest nDCG {best:.3f}. Cheapest within {args.tolerance}: chunks={cheapest['chunks']} "
+          f"factory={cheapest['factory']} mode={cheapest['mode']} reranker={cheapest['reranker']} "
+          f"top_k={cheapest['top_k']} fused_k={cheapest['fused_k']} rerank_k={cheapest['rerank_k']} "
+          f"({cheapest['ms']:.2f} ms/query)")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
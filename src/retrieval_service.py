@@ -0,0 +1,78 @@
+# src/retrieval_service.py
+#
+# Общий retrieval-сервис для нескольких процессов бота:
+#   python src/retrieval_service.py            # адрес из retrieve.service_url
+#   python src/retrieval_service.py --url unix:/tmp/aitu-retriever.sock
+# Держит одну копию индекса, эмбеддера и reranker'а. Одновременные запросы
+# от всех воркеров склеиваются микро-батчером retriever в общие encode/search/predict.
+
+import argparse
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from aiohttp import web
+
+import retriever
+from retrieval_client import pack, unpack, SERVICE_URL
+
+logger = logging.getLogger("retrieval_service")
+
+THREADS = retriever.cfg["retrieve"].get("service_threads", 32)
+
+def make_app() -> web.Application:
+    # потоки ждут результата своего элемента в MicroBatcher: чем их больше,
+    # тем больше одновременных запросов попадает в один батч
+    pool = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix="retrieval")
+
+    async def run(fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+    async def embed(request: web.Request) -> web.Response:
+        body = await request.json()
+        qv = await run(retriever.embed_query, body["query"])
+        return web.json_response({"qv": pack(qv)})
+
+    async def retrieve(request: web.Request) -> web.Response:
+        body = await request.json()
+        qv = unpack(body["qv"]) if body.get("qv") else None
+        docs = await run(retriever.retrieve, body["query"], qv, body.get("filters"))
+        return web.json_response({"docs": docs})
+
+    async def reload(request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response({"reloaded": await run(retriever.reload_index, bool(body.get("force")))})
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"version": retriever.current_state().version})
+
+    async def on_cleanup(app: web.Application) -> None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    app = web.Application(client_max_size=4 << 20)
+    app.router.add_post("/embed", embed)
+    app.router.add_post("/retrieve", retrieve)
+    app.router.add_post("/reload", reload)
+    app.router.add_get("/health", health)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Shared retrieval service")
+    ap.add_argument("--url", default=SERVICE_URL or "http://127.0.0.1:8765",
+                    help="http://host:port или unix:/path/to.sock")
+    args = ap.parse_args()
+
+    retriever.init()
+    retriever.start_watcher()
+
+    u = urlparse(args.url)
+    logger.info(f"Retrieval service listening on {args.url}")
+    if u.scheme == "unix":
+        web.run_app(make_app(), path=u.path, print=None)
+    else:
+        web.run_app(make_app(), host=u.hostname or "127.0.0.1", port=u.port or 8765, print=None)
+
+if __name__ == "__main__":
+    main()
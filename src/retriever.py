@@ -1,12 +1,21 @@
 # src/retriever.py
 
 import os
-import pickle
+import re
+import time
 import logging
+import threading
 import yaml
 
+import numpy as np
 import faiss
-from sentence_transformers import SentenceTransformer, CrossEncoder
+
+import inference
+from batcher    import MicroBatcher
+from chunkstore import ChunkStore
+from lang       import detect_query_lang
+from lexical    import BM25Index, is_keyword_query, rrf
+from metrics    import timed
 
 def load_config():
     src  = os.path.dirname(os.path.abspath(__file__))
@@ -24,48 +33,334 @@ cfg  = load_config()
 ROOT = project_root()
 
 IDX_DIR   = os.path.join(ROOT, cfg["data"]["faiss_index_dir"])
-IDX_PATH  = os.path.join(IDX_DIR, "index.faiss")
-META_PATH = os.path.join(IDX_DIR, "metadata.pkl")
+# indexer.py пишет сюда имя готового снимка (index.faiss + chunks/) последним
+VER_PATH  = os.path.join(IDX_DIR, "VERSION")
 
 TOP_K  = cfg["retrieve"]["top_k"]
 RR_K   = cfg["retrieve"]["rerank_k"]
 CE_MOD = cfg["retrieve"]["cross_encoder_model"]
 EMB_MOD = cfg["embed"]["model_name"]
+# бэкенд CPU-инференса (src/inference.py): torch | int8 | onnx
+EMB_BACKEND = cfg["embed"].get("query_backend", "torch")
+EMB_ONNX    = cfg["embed"].get("onnx_file")
+CE_BACKEND  = cfg["retrieve"].get("reranker_backend", "torch")
+CE_ONNX     = cfg["retrieve"].get("reranker_onnx_file")
+# torch.set_num_threads действует на весь процесс — одна настройка на обе модели
+THREADS     = cfg["retrieve"].get("inference_threads")
+BATCH   = cfg["retrieve"].get("batch_size", 16)
+WAIT_MS = cfg["retrieve"].get("batch_wait_ms", 5)
+RELOAD_INTERVAL = cfg["retrieve"].get("reload_interval", 10)
+MMAP_INDEX      = cfg["retrieve"].get("mmap_index", True)
+LANG_ROUTING    = cfg["retrieve"].get("lang_routing", True)
+LANG_MIN        = cfg["retrieve"].get("lang_min_results", 3)   # меньше — добираем из "all"
+LANG_MIN_SCORE  = cfg["retrieve"].get("lang_min_score", 0.3)    # лучший score в шарде ниже — тоже
+OVERFETCH       = 4   # запас для пост-фильтрации, если индекс не поддерживает IDSelector
+MODE            = cfg["retrieve"].get("mode", "dense")           # dense | hybrid
+LEX_K           = cfg["retrieve"].get("lexical_top_k", TOP_K)    # кандидатов из BM25
+FUSED_K         = cfg["retrieve"].get("fused_k", TOP_K)          # кандидатов после RRF (на reranker)
+RRF_K           = cfg["retrieve"].get("rrf_k", 60)
+BM25_K1         = cfg["retrieve"].get("bm25_k1", 1.2)
+BM25_B          = cfg["retrieve"].get("bm25_b", 0.75)
+FAST_PATH       = cfg["retrieve"].get("lexical_fast_path", True)
+FAST_MAX_WORDS  = cfg["retrieve"].get("fast_path_max_words", 3)
+
+class IndexState:
+    """
+    Индекс + метаданные одной версии. Объект неизменяемый: при перезагрузке
+    создаётся новый и подменяется одной операцией присваивания, так что
+    запрос всегда видит согласованную пару index/metadata.
+    """
+    def __init__(self, index, metadata, version, shards=None, lexical=None):
+        self.index    = index
+        self.metadata = metadata
+        self.version  = version
+        self.shards   = shards or {}      # язык → индекс только с чанками этого языка
+        self.lexical  = lexical           # BM25Index или None (снимок без bm25/)
+        self._allowed: dict[tuple, np.ndarray] = {}
+
+    def allowed_ids(self, filters: tuple) -> np.ndarray:
+        """
+        ID чанков, проходящих фильтры; кэшируется на время жизни версии.
+        """
+        ids = self._allowed.get(filters)
+        if ids is None:
+            ids = self.metadata.select(**dict(filters))
+            self._allowed[filters] = ids
+        return ids
+
+def index_version() -> str | None:
+    try:
+        with open(VER_PATH, encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def read_index(path: str) -> faiss.Index:
+    if MMAP_INDEX:
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            # не все типы индексов поддерживают mmap
+            logger.warning(f"mmap load failed ({e}), reading index into memory")
+    return faiss.read_index(path)
+
+def load_state() -> IndexState:
+    version = index_version()
+    if version is None:
+        raise FileNotFoundError(f"{VER_PATH} not found — run `python -m src.indexer` first")
+    snap = os.path.join(IDX_DIR, version)
+    logger.info(f"Loading index snapshot {snap}")
+    idx  = read_index(os.path.join(snap, "index.faiss"))
+    meta = ChunkStore(os.path.join(snap, "chunks"))
+    shards = {}
+    for fn in os.listdir(snap):
+        m = re.fullmatch(r"index\.(.+)\.faiss", fn)
+        if m:
+            shards[m.group(1)] = read_index(os.path.join(snap, fn))
+    lexical = None
+    if os.path.isdir(os.path.join(snap, "bm25")):
+        lexical = BM25Index(os.path.join(snap, "bm25"), BM25_K1, BM25_B)
+    elif MODE == "hybrid":
+        logger.warning("Snapshot has no bm25/ index, hybrid retrieval falls back to dense")
+    logger.info(f"Loaded {len(meta)} entries, language shards: {sorted(shards) or '-'}")
+    return IndexState(idx, meta, version, shards, lexical)
+
+# Всё тяжёлое (индекс, модели) грузится при первом обращении, а не при импорте:
+# импорт модуля дешёвый, а процессы с retrieval-сервисом моделей не грузят вовсе.
+_state: IndexState | None = None
+_reload_lock = threading.Lock()
+
+def current_state() -> IndexState:
+    if _state is None:
+        reload_index()
+    return _state
+
+def reload_index(force: bool = False) -> bool:
+    """
+    Загружает новую версию индекса (в вызывающем потоке) и подменяет текущую.
+    Старый индекс освобождается, когда его отпустят запросы, начатые до подмены.
+    """
+    global _state
+    with _reload_lock:
+        if _state is not None and not force and index_version() == _state.version:
+            return False
+        new_state = load_state()
+        _state = new_state
+        logger.info(f"Index swapped, version {new_state.version}")
+        return True
+
+def _watch_loop(interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        try:
+            reload_index()
+        except Exception:
+            # индексатор мог быть ещё не закончен — попробуем на следующем круге
+            logger.exception("Index reload failed")
+
+_watcher: threading.Thread | None = None
+
+def start_watcher(interval: float = RELOAD_INTERVAL) -> None:
+    global _watcher
+    if interval <= 0 or _watcher is not None:
+        return
+    _watcher = threading.Thread(target=_watch_loop, args=(interval,), name="index-watcher", daemon=True)
+    _watcher.start()
+
+_embedder = None
+_reranker = None
+_models_lock = threading.Lock()
+
+def get_embedder():
+    global _embedder
+    with _models_lock:
+        if _embedder is None:
+            _embedder = inference.load_embedder(EMB_MOD, EMB_BACKEND, EMB_ONNX, THREADS)
+    return _embedder
+
+def get_reranker():
+    global _reranker
+    if not CE_MOD:
+        return None
+    with _models_lock:
+        if _reranker is None:
+            _reranker = inference.load_cross_encoder(CE_MOD, CE_BACKEND, CE_ONNX, THREADS)
+    return _reranker
+
+def init() -> None:
+    """
+    Явная загрузка индекса и моделей (на старте бота или сервиса),
+    чтобы их не ждал первый вопрос.
+    """
+    current_state()
+    get_embedder()
+    get_reranker()
 
-logger.info(f"Loading index from {IDX_PATH}")
-index = faiss.read_index(IDX_PATH)
-with open(META_PATH, "rb") as f:
-    metadata = pickle.load(f)
-logger.info(f"Loaded {len(metadata)} entries")
-
-logger.info(f"Loading embedder {EMB_MOD}")
-embedder = SentenceTransformer(EMB_MOD)
-reranker = CrossEncoder(CE_MOD) if CE_MOD else None
-
-def retrieve(query: str) -> list[dict]:
-    qv = embedder.encode([query], normalize_embeddings=True)
-    D, I = index.search(qv, TOP_K)
-    D, I = D[0], I[0]
-
-    docs = []
-    for dist, idx in zip(D, I):
-        entry = metadata[idx].copy()
-        docs.append({
-            "score": float(dist),
-            "text":  entry.pop("text"),
-            **entry
-        })
+def embed_batch(queries: list[str]) -> np.ndarray:
+    embedder = get_embedder()
+    with timed("encode"):
+        return embedder.encode(queries, batch_size=len(queries), normalize_embeddings=True)
 
+def lexical_fast_path(query: str) -> bool:
+    """
+    Короткий запрос из ключевых слов ищется только по BM25 — без эмбеддера.
+    """
+    return MODE == "hybrid" and FAST_PATH and is_keyword_query(query, FAST_MAX_WORDS)
+
+def freeze_filters(filters: dict | None) -> tuple:
+    # фильтры как хэшируемый ключ: для кэша ID и дедупликации в батчере
+    return tuple(sorted((k, v) for k, v in (filters or {}).items() if v is not None))
+
+def search_params(idx: faiss.Index, sel) -> faiss.SearchParameters:
+    try:
+        ivf = faiss.extract_index_ivf(idx)
+        return faiss.SearchParametersIVF(sel=sel, nprobe=ivf.nprobe)
+    except RuntimeError:
+        return faiss.SearchParameters(sel=sel)
+
+def search(st: IndexState, idx: faiss.Index, Q: np.ndarray, filters: tuple):
+    """
+    Поиск с фильтром по метаданным через IDSelector (внутри FAISS);
+    если тип индекса этого не умеет — поиск с запасом и пост-фильтрация.
+    """
+    if not filters:
+        return idx.search(Q, TOP_K)
+    allowed = st.allowed_ids(filters)
+    try:
+        sel = faiss.IDSelectorBatch(allowed)
+        return idx.search(Q, TOP_K, params=search_params(idx, sel))
+    except RuntimeError:
+        D, I = idx.search(Q, TOP_K * OVERFETCH)
+        ok = np.isin(I, allowed)
+        Dn = np.full((len(Q), TOP_K), -np.inf, dtype="float32")
+        In = np.full((len(Q), TOP_K), -1, dtype="int64")
+        for r in range(len(Q)):
+            keep = np.nonzero(ok[r])[0][:TOP_K]
+            Dn[r, :len(keep)] = D[r, keep]
+            In[r, :len(keep)] = I[r, keep]
+        return Dn, In
+
+def retrieve_batch(queries: list[str], qvs: list | None = None,
+                   filters: list[tuple] | None = None) -> list[list[dict]]:
+    """
+    Поиск сразу для нескольких запросов: один encode (только для тех, у кого
+    нет готового вектора), по одному index.search на группу (языковой шард,
+    фильтр) и один reranker.predict.
+    В режиме hybrid к FAISS добавляется BM25 (слияние через RRF), а короткие
+    запросы из ключевых слов ищутся только по BM25, без эмбеддинга.
+    """
+    qvs = list(qvs) if qvs is not None else [None] * len(queries)
+    filters = list(filters) if filters is not None else [()] * len(queries)
+    st = current_state()  # одна версия индекса на весь батч
+
+    lexical = st.lexical if MODE == "hybrid" else None
+    fast = [lexical is not None and v is None and lexical_fast_path(q) for q, v in zip(queries, qvs)]
+    lex_hits: dict[int, list[tuple[int, float]]] = {}
+    if any(fast):
+        with timed("lexical"):
+            for i in np.flatnonzero(fast):
+                allowed = st.allowed_ids(filters[i]) if filters[i] else None
+                lex_hits[i] = lexical.search(queries[i], LEX_K, allowed)
+        # ни одного совпадения по словам — обычный dense-поиск
+        fast = [f and bool(lex_hits[i]) for i, f in enumerate(fast)]
+    dense = [i for i in range(len(queries)) if not fast[i]]
+
+    missing = [i for i in dense if qvs[i] is None]
+    if missing:
+        enc = embed_batch([queries[i] for i in missing])
+        for i, v in zip(missing, enc):
+            qvs[i] = v
+
+    D = np.full((len(queries), TOP_K), -np.inf, dtype="float32")
+    I = np.full((len(queries), TOP_K), -1, dtype="int64")
+    if dense:
+        Q = np.zeros((len(queries), np.asarray(qvs[dense[0]]).size), dtype="float32")
+        for i in dense:
+            Q[i] = np.asarray(qvs[i]).reshape(-1)
+
+        # Маршрутизация: язык вопроса → шард этого языка (если он есть)
+        shard_of = {
+            i: lang if LANG_ROUTING and (lang := detect_query_lang(queries[i])) in st.shards else "all"
+            for i in dense
+        }
+        groups: dict[tuple, list[int]] = {}
+        for i in dense:
+            groups.setdefault((shard_of[i], filters[i]), []).append(i)
+        with timed("search"):
+            for (shard, filt), rows in groups.items():
+                idx = st.shards[shard] if shard != "all" else st.index
+                D[rows], I[rows] = search(st, idx, Q[rows], filt)
+
+            # Мало результатов в шарде языка или все слабые (язык определён неверно,
+            # ответ на странице другого языка) — повторяем по всему индексу
+            sparse = [i for i in dense if shard_of[i] != "all"
+                      and ((I[i] >= 0).sum() < LANG_MIN or D[i, 0] < LANG_MIN_SCORE)]
+            by_filter: dict[tuple, list[int]] = {}
+            for i in sparse:
+                by_filter.setdefault(filters[i], []).append(i)
+            for filt, rows in by_filter.items():
+                D[rows], I[rows] = search(st, st.index, Q[rows], filt)
+            for i in sparse:
+                shard_of[i] = "all"
+
+    hits_of = [[(int(u), float(d)) for d, u in zip(D[i], I[i]) if u >= 0] for i in range(len(queries))]
+    if lexical is not None:
+        with timed("lexical"):
+            for i in dense:
+                # BM25 — в тех же границах, что и FAISS: фильтры + языковой шард
+                filt = filters[i] if shard_of[i] == "all" else tuple(sorted(filters[i] + (("lang", shard_of[i]),)))
+                allowed = st.allowed_ids(filt) if filt else None
+                hits_of[i] = rrf([hits_of[i], lexical.search(queries[i], LEX_K, allowed)], RRF_K)[:FUSED_K]
+        for i in lex_hits:
+            if fast[i]:
+                hits_of[i] = lex_hits[i][:FUSED_K]
+
+    results = []
+    for hits in hits_of:
+        # ChunkStore: uid → свежий dict
+        results.append([{"score": score, **st.metadata[uid]} for uid, score in hits])
+
+    reranker = get_reranker()
     if reranker:
-        pairs  = [[query, d["text"]] for d in docs]
-        scores = reranker.predict(pairs)
-        ranked = sorted(zip(docs, scores), key=lambda x: x[1], reverse=True)
-        docs = []
-        for d, s in ranked[:RR_K]:
-            d["score"] = float(s)
-            docs.append(d)
-
-    return docs
+        pairs = [[q, d["text"]] for q, docs in zip(queries, results) for d in docs]
+        with timed("rerank"):
+            scores = reranker.predict(pairs) if pairs else []
+        pos = 0
+        for n, docs in enumerate(results):
+            doc_scores = scores[pos:pos + len(docs)]
+            pos += len(docs)
+            ranked = sorted(zip(docs, doc_scores), key=lambda x: x[1], reverse=True)
+            results[n] = []
+            for d, s in ranked[:RR_K]:
+                d["score"] = float(s)
+                results[n].append(d)
+
+    return results
+
+# Микро-батчинг: одновременные запросы из разных потоков бота склеиваются
+# в один encode / search / predict. batch_size <= 1 — без батчинга.
+if BATCH > 1:
+    _embed_batcher = MicroBatcher(embed_batch, BATCH, WAIT_MS, name="embed-batcher")
+    _retrieve_batcher = MicroBatcher(
+        lambda items: retrieve_batch([q for q, _, _ in items], [v for _, v, _ in items], [f for _, _, f in items]),
+        BATCH, WAIT_MS, name="retrieve-batcher",
+    )
+else:
+    _embed_batcher = _retrieve_batcher = None
+
+def embed_query(query: str):
+    if _embed_batcher is None:
+        return embed_batch([query])
+    return _embed_batcher(query, query).reshape(1, -1)
+
+def retrieve(query: str, qv=None, filters: dict | None = None) -> list[dict]:
+    """
+    filters — фильтры по метаданным, например {"url_prefix": "/programs/"}.
+    """
+    filt = freeze_filters(filters)
+    if _retrieve_batcher is None:
+        return retrieve_batch([query], [qv], [filt])[0]
+    return _retrieve_batcher((query, filt), (query, qv, filt))
 
 if __name__ == "__main__":
     q = input("Q: ")
@@ -1,15 +1,20 @@
 # src/telegram_bot.py
 
 import os
+import time
 import logging
 import asyncio
+import yaml
 
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command, CommandObject
 
-from rag_engine import answer_question
-from model      import generate_answer, set_model, CURRENT_MODEL
+import model
+from async_rag  import answer_question_stream, areload_index, ainit, start_watcher, shutdown
+from model      import set_model, ensure_warm, warmup_all, refresh_state, start_balancer, MODELS
+from rag_engine import SYSTEM_PROMPT
+from metrics    import start_server as start_metrics
 
 # Загрузка .env
 ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -19,22 +24,42 @@ TOKEN = os.getenv("TELEGRAM_TOKEN")
 if not TOKEN:
     raise RuntimeError("TELEGRAM_TOKEN not set")
 
+# Telegram user id администраторов через запятую (для /reload)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+
 logging.basicConfig(
     format="%(asctime)s %(levelname)s:%(name)s: %(message)s",
     level=logging.INFO
 )
 logger = logging.getLogger("telegram_bot_aiogram")
 
+with open(os.path.join(ROOT, "config.yaml"), encoding="utf-8") as f:
+    cfg = yaml.safe_load(f)
+CONC = cfg.get("concurrency", {})
+
+MAX_INFLIGHT   = CONC.get("max_inflight", 4)
+PER_CHAT_QUEUE = CONC.get("per_chat_queue", 3)
+EDIT_INTERVAL  = cfg.get("telegram", {}).get("edit_interval", 1.0)
+MET_CFG        = cfg.get("metrics", {})
+MAX_MSG_LEN    = 4096
+
 bot = Bot(token=TOKEN)
 dp  = Dispatcher()
 
+# Ограничение одновременно обрабатываемых RAG-запросов на весь бот
+inflight = asyncio.Semaphore(MAX_INFLIGHT)
+# Очередь вопросов и воркер на каждый чат: ответы в чате идут по порядку,
+# а разные чаты обрабатываются параллельно
+chat_queues:  dict[int, asyncio.Queue]  = {}
+chat_workers: dict[int, asyncio.Task]   = {}
+
 @dp.message(Command("start"))
 async def cmd_start(msg: types.Message):
     text = (
         "Привет! Я виртуальный помощник AITU.\n"
         "Задай мне любой вопрос о поступлении, факультетах и т.д.\n\n"
-        f"Текущая модель: *{CURRENT_MODEL}*\n"
-        "Чтобы сменить модель, используй команду /setmodel `<deepseek|mistral|llama3>`.\n"
+        f"Текущая модель: *{model.CURRENT_MODEL}*\n"
+        f"Чтобы сменить модель, используй команду /setmodel `<{'|'.join(MODELS)}>`.\n"
     )
     await msg.answer(text, parse_mode="Markdown")
 
@@ -42,42 +67,141 @@ async def cmd_start(msg: types.Message):
 async def cmd_setmodel(msg: types.Message, command: CommandObject):
     """
     Ожидаем: /setmodel <имя>
-    Допустимые имена: deepseek, mistral, llama3
+    Допустимые имена: llm.models в config.yaml (deepseek, mistral, llama3)
     """
     args  = command.args or ""
     choice = args.strip().lower()
-    if choice not in ("deepseek", "mistral", "llama3"):
-        await msg.answer("❗ Неверное название модели. Варианты: deepseek, mistral, llama3.")
+    if choice not in MODELS:
+        await msg.answer(f"❗ Неверное название модели. Варианты: {', '.join(MODELS)}.")
         return
 
     try:
+        # сначала прогреваем, потом переключаем: вопросы не попадут на холодную модель
+        await ensure_warm(choice, SYSTEM_PROMPT)
         set_model(choice)
         await msg.answer(f"✅ Модель успешно сменена на *{choice}*.", parse_mode="Markdown")
     except ValueError as e:
         await msg.answer(f"❗ Ошибка: {e}")
+    except Exception as e:
+        logger.exception(f"Warmup of {choice} failed")
+        await msg.answer(f"❗ Не удалось загрузить модель {choice}: {e}")
+
+@dp.message(Command("models"))
+async def cmd_models(msg: types.Message):
+    """
+    Какие модели сейчас загружены в Ollama и когда будут выгружены.
+    """
+    try:
+        states = await refresh_state()
+    except Exception as e:
+        await msg.answer(f"❗ Ollama недоступна: {e}")
+        return
+    lines = [
+        f"{'▶' if name == model.CURRENT_MODEL else '•'} {name}: {st['state']}"
+        + (f" (до {st['expires_at']})" if st.get("expires_at") else "")
+        for name, st in states.items()
+    ]
+    await msg.answer("\n".join(lines))
+
+@dp.message(Command("reload"))
+async def cmd_reload(msg: types.Message):
+    """
+    Перечитать FAISS-индекс и метаданные без перезапуска бота (только админы).
+    """
+    if msg.from_user is None or msg.from_user.id not in ADMIN_IDS:
+        await msg.answer("❗ Команда доступна только администраторам.")
+        return
+    try:
+        await areload_index()
+        await msg.answer("✅ Индекс перезагружен.")
+    except Exception as e:
+        logger.exception("Index reload failed")
+        await msg.answer(f"❗ Ошибка перезагрузки индекса: {e}")
+
+async def stream_reply(msg: types.Message, q: str) -> None:
+    """
+    Отправляет заглушку и дописывает в неё ответ по мере генерации.
+    Правки не чаще EDIT_INTERVAL, чтобы не упереться в лимиты Telegram.
+    """
+    placeholder = await msg.answer("⏳ …")
+    parts: list[str] = []
+    shown     = ""
+    last_edit = 0.0
+    async for part in answer_question_stream(q):
+        parts.append(part)
+        now = time.monotonic()
+        if now - last_edit < EDIT_INTERVAL:
+            continue
+        text = "".join(parts).strip()[:MAX_MSG_LEN]
+        if text and text != shown:
+            await placeholder.edit_text(text)
+            shown, last_edit = text, now
+
+    final = "".join(parts).strip()[:MAX_MSG_LEN] or "Hmm, I’m not sure."
+    if final != shown:
+        await placeholder.edit_text(final)
+
+async def chat_worker(chat_id: int):
+    queue = chat_queues[chat_id]
+    while not queue.empty():
+        msg = queue.get_nowait()
+        q   = msg.text.strip()
+        try:
+            async with inflight:
+                await stream_reply(msg, q)
+        except Exception:
+            logger.exception("Error in RAG engine")
+            try:
+                await msg.answer("⚠️ Извините, при обработке запроса произошла ошибка.")
+            except Exception:
+                logger.exception("Failed to send answer")
+    chat_workers.pop(chat_id, None)
+    chat_queues.pop(chat_id, None)
 
 @dp.message()
 async def handle_q(msg: types.Message):
+    if not msg.text:
+        return
     q = msg.text.strip()
+    chat_id = msg.chat.id
     logger.info(f"Received question: {q!r}")
-    try:
-        a = answer_question(q)
-    except Exception:
-        logger.exception("Error in RAG engine")
-        a = "⚠️ Извините, при обработке запроса произошла ошибка."
-    await msg.answer(a)
+
+    queue = chat_queues.setdefault(chat_id, asyncio.Queue(maxsize=PER_CHAT_QUEUE))
+    if queue.full():
+        # backpressure: не копим бесконечную очередь от одного пользователя
+        await msg.answer("⏳ Подождите, я ещё отвечаю на ваши предыдущие вопросы.")
+        return
+    if inflight.locked():
+        await msg.answer("⏳ Сейчас много запросов, ваш вопрос в очереди…")
+    queue.put_nowait(msg)
+
+    if chat_id not in chat_workers:
+        chat_workers[chat_id] = asyncio.create_task(chat_worker(chat_id))
 
 async def main():
-    # 1) Warmup: прогрев модели одним коротким запросом
-    try:
-        _ = generate_answer(" ")
-        logger.info("Ollama model warmed up successfully")
-    except Exception:
-        logger.exception("Model warmup failed; first request may be slow")
+    # 1) Опрос серверов Ollama и прогрев: загружаем все разрешённые модели
+    #    и прогоняем system-префикс
+    await start_balancer()
+    await warmup_all(SYSTEM_PROMPT)
 
-    # 2) Старт polling
+    # 2) Индекс и модели поиска (или retrieval-сервис); следим за новыми
+    #    версиями индекса (indexer.py пишет VERSION)
+    await ainit()
+    start_watcher()
+
+    # Гистограммы стадий для Prometheus
+    metrics_runner = None
+    if MET_CFG.get("enabled", True):
+        metrics_runner = await start_metrics(MET_CFG.get("host", "127.0.0.1"), MET_CFG.get("port", 9108))
+
+    # 3) Старт polling
     logger.info("Starting aiogram bot polling…")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())
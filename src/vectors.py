@@ -0,0 +1,100 @@
+# src/vectors.py
+
+import os
+
+import numpy as np
+
+# Хранение эмбеддингов на диске: .npy (float32 | float16 | int8) + для int8
+# построчный масштаб в <name>_scale.npy. Всё открывается через memmap,
+# в память попадают только читаемые блоки.
+
+DTYPES = ("float32", "float16", "int8")
+
+def scale_path(path: str) -> str:
+    return path[:-len(".npy")] + "_scale.npy"
+
+def quantize(v: np.ndarray, dtype: str) -> tuple[np.ndarray, np.ndarray | None]:
+    """
+    float32-векторы → формат хранения. Для int8 симметричный масштаб на строку.
+    """
+    v = np.asarray(v, dtype="float32")
+    if dtype == "float32":
+        return v, None
+    if dtype == "float16":
+        return v.astype("float16"), None
+    if dtype == "int8":
+        scale = np.abs(v).max(axis=1) / 127
+        scale[scale == 0] = 1
+        q = np.clip(np.rint(v / scale[:, None]), -127, 127).astype("int8")
+        return q, scale.astype("float32")
+    raise ValueError(f"Unsupported storage dtype '{dtype}'. Valid: {', '.join(DTYPES)}.")
+
+def dequantize(q: np.ndarray, scale: np.ndarray | None) -> np.ndarray:
+    if scale is None:
+        return np.ascontiguousarray(q, dtype="float32")
+    return np.ascontiguousarray(q.astype("float32") * scale[:, None])
+
+def l2_normalize(x: np.ndarray) -> np.ndarray:
+    """
+    Новый массив с единичными строками: для нормированных векторов
+    inner product == косинус, как при поиске с normalize_embeddings=True.
+    """
+    x = np.array(x, dtype="float32", copy=True)
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    x /= norms
+    return x
+
+def create(path: str, n: int, d: int, dtype: str):
+    """
+    Предвыделенный memmap .npy (n, d) и, для int8, массив масштабов.
+    """
+    vecs  = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(n, d))
+    scale = np.lib.format.open_memmap(scale_path(path), mode="w+", dtype="float32", shape=(n,)) if dtype == "int8" else None
+    return vecs, scale
+
+class VectorFile:
+    """
+    Read-only доступ к эмбеддингам на диске без загрузки целиком.
+    """
+
+    def __init__(self, path: str, mode: str = "r"):
+        self.path  = path
+        self.vecs  = np.load(path, mmap_mode=mode)
+        sp = scale_path(path)
+        self.scale = np.load(sp, mmap_mode=mode) if self.vecs.dtype == np.int8 and os.path.exists(sp) else None
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.vecs.shape
+
+    def __len__(self) -> int:
+        return self.vecs.shape[0]
+
+    def raw(self, a: int, b: int) -> tuple[np.ndarray, np.ndarray | None]:
+        return self.vecs[a:b], None if self.scale is None else self.scale[a:b]
+
+    def block(self, a: int, b: int, normalize: bool = False) -> np.ndarray:
+        x = dequantize(*self.raw(a, b))
+        return l2_normalize(x) if normalize else x
+
+    def take(self, rows: np.ndarray, normalize: bool = False) -> np.ndarray:
+        x = dequantize(self.vecs[rows], None if self.scale is None else self.scale[rows])
+        return l2_normalize(x) if normalize else x
+
+    def iter_blocks(self, size: int, rows: np.ndarray | None = None, normalize: bool = False):
+        """
+        (позиции строк, float32-блок) по size строк; rows — подмножество строк.
+        """
+        if rows is None:
+            for a in range(0, len(self), size):
+                b = min(a + size, len(self))
+                yield np.arange(a, b), self.block(a, b, normalize)
+        else:
+            for a in range(0, len(rows), size):
+                part = rows[a:a + size]
+                yield part, self.take(part, normalize)
+
+    def close(self) -> None:
+        # на Windows файл нельзя заменить, пока открыт memmap
+        self.vecs = self.scale = None
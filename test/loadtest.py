@@ -0,0 +1,259 @@
+# loadtest.py
+#
+# Нагрузочный тест всего пайплайна (retrieve → prompt → LLM) на заглушке Ollama:
+#   python test/loadtest.py test/test.txt test/ytest.txt --concurrency 4 --mode async
+#   python test/loadtest.py test/test.txt --save-baseline test/baseline.json
+#   python test/loadtest.py test/test.txt --baseline test/baseline.json   # код выхода 1 при регрессии
+#
+# Режимы: sync — rag_engine.answer_question в пуле потоков, async — async_rag.answer_question_stream,
+# bot — telegram_bot.handle_q с поддельными сообщениями (очереди чатов, inflight, правки сообщений).
+# Заглушка (test/stub_ollama.py) запускается отдельным процессом, чтобы не искажать CPU/RSS;
+# --ollama URL — вместо неё настоящий сервер.
+
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC  = os.path.join(os.path.dirname(HERE), "src")
+
+STAGES = ["total", "cache", "retrieve", "context", "prompt", "llm", "llm_ttft"]
+
+def load_questions(paths: list[str]) -> list[str]:
+    """
+    Вопросы из TSV-файлов test/*.txt (колонка «Вопрос»), без повторов.
+    """
+    seen: dict[str, None] = {}
+    for path in paths:
+        with open(path, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f, delimiter="\t"):
+                q = (row.get("Вопрос") or "").strip()
+                if q:
+                    seen.setdefault(q, None)
+    return list(seen)
+
+def start_stub(port: int, tokens: int, delay: float) -> subprocess.Popen:
+    proc = subprocess.Popen([
+        sys.executable, os.path.join(HERE, "stub_ollama.py"),
+        "--port", str(port), "--tokens", str(tokens), "--delay", str(delay),
+    ])
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Stub Ollama did not start")
+
+class TraceCollector:
+    """
+    Подменяет rag_engine.interactions: вместо записи в файл собирает тайминги стадий.
+    """
+
+    def __init__(self):
+        self.records: list[dict] = []
+
+    def write(self, record: dict) -> None:
+        self.records.append(record)
+
+    def close(self) -> None:
+        pass
+
+def run_sync(questions: list[str], concurrency: int) -> list[float]:
+    from rag_engine import answer_question
+
+    def one(q: str) -> float:
+        t0 = time.perf_counter()
+        answer_question(q)
+        return time.perf_counter() - t0
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, questions))
+
+async def run_async(questions: list[str], concurrency: int) -> list[float]:
+    from async_rag import answer_question_async, shutdown
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(q: str) -> float:
+        async with sem:
+            t0 = time.perf_counter()
+            await answer_question_async(q)
+            return time.perf_counter() - t0
+
+    try:
+        return await asyncio.gather(*(one(q) for q in questions))
+    finally:
+        await shutdown()
+
+class FakeMessage:
+    """
+    Минимум aiogram.types.Message, который трогает telegram_bot: text, chat.id, answer, edit_text.
+    """
+
+    class Chat:
+        def __init__(self, chat_id: int):
+            self.id = chat_id
+
+    def __init__(self, text: str, chat_id: int):
+        self.text = text
+        self.chat = self.Chat(chat_id)
+        self.from_user = None
+        self.last_update = 0.0
+
+    async def answer(self, text: str, **kwargs) -> "FakeMessage":
+        self.last_update = time.perf_counter()
+        reply = FakeMessage(text, self.chat.id)
+        reply.parent = self
+        return reply
+
+    async def edit_text(self, text: str, **kwargs) -> None:
+        self.text = text
+        self.parent.last_update = time.perf_counter()
+
+async def run_bot(questions: list[str], concurrency: int) -> list[float]:
+    # aiogram проверяет только формат токена; в сеть бот здесь не ходит
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:LOADTEST")
+    import telegram_bot
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(n: int, q: str) -> float:
+        async with sem:
+            msg = FakeMessage(q, chat_id=n)   # один чат на вопрос — как разные пользователи
+            t0 = time.perf_counter()
+            await telegram_bot.handle_q(msg)
+            await telegram_bot.chat_workers[n]
+            return msg.last_update - t0
+
+    try:
+        return await asyncio.gather(*(one(n, q) for n, q in enumerate(questions)))
+    finally:
+        await telegram_bot.shutdown()
+
+def percentiles(values) -> dict:
+    if len(values) == 0:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 4), "p95": round(float(p95), 4), "p99": round(float(p99), 4), "n": len(values)}
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Регрессия: p50/p95 стадии выросли больше чем на tolerance или QPS упал больше чем на tolerance.
+    """
+    problems = []
+    for stage, base in baseline.get("stages", {}).items():
+        cur = report["stages"].get(stage)
+        if not cur:
+            continue
+        for p in ("p50", "p95"):
+            if base.get(p) and cur[p] > base[p] * (1 + tolerance):
+                problems.append(f"{stage} {p}: {cur[p]:.3f}s vs baseline {base[p]:.3f}s")
+    if baseline.get("qps") and report["qps"] < baseline["qps"] * (1 - tolerance):
+        problems.append(f"QPS: {report['qps']:.2f} vs baseline {baseline['qps']:.2f}")
+    return problems
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="RAG load test")
+    ap.add_argument("questions", nargs="+", help="TSV-файлы с колонкой «Вопрос» (test/test.txt …)")
+    ap.add_argument("--mode", choices=["sync", "async", "bot"], default="async")
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--repeat", type=int, default=1, help="сколько раз прогнать список вопросов")
+    ap.add_argument("--cache", action="store_true", help="не отключать кэш ответов")
+    ap.add_argument("--ollama", help="URL настоящей Ollama вместо заглушки")
+    ap.add_argument("--stub-port", type=int, default=11599)
+    ap.add_argument("--tokens", type=int, default=80, help="токенов в ответе заглушки")
+    ap.add_argument("--token-delay", type=float, default=0.03, help="сек. между токенами заглушки")
+    ap.add_argument("--out", help="сохранить отчёт в JSON")
+    ap.add_argument("--baseline", help="сравнить с сохранённым отчётом")
+    ap.add_argument("--save-baseline", help="сохранить отчёт как baseline")
+    ap.add_argument("--tolerance", type=float, default=0.2)
+    args = ap.parse_args()
+
+    questions = load_questions(args.questions) * args.repeat
+    print(f"{len(questions)} questions, mode={args.mode}, concurrency={args.concurrency}")
+
+    stub = None
+    if args.ollama:
+        os.environ["OLLAMA_URL"] = args.ollama
+    else:
+        stub = start_stub(args.stub_port, args.tokens, args.token_delay)
+        os.environ["OLLAMA_URL"] = f"http://127.0.0.1:{args.stub_port}"
+
+    try:
+        # модули бота читают OLLAMA_URL при импорте — только после запуска заглушки
+        sys.path.insert(0, SRC)
+        import rag_engine
+        collector = TraceCollector()
+        rag_engine.interactions = collector
+        if not args.cache:
+            rag_engine.answer_cache = None
+
+        # прогрев моделей и индекса не входит в замер
+        rag_engine.answer_question("warmup")
+        collector.records.clear()
+
+        ru0, wall0 = resource.getrusage(resource.RUSAGE_SELF), time.perf_counter()
+        if args.mode == "sync":
+            totals = run_sync(questions, args.concurrency)
+        elif args.mode == "async":
+            totals = asyncio.run(run_async(questions, args.concurrency))
+        else:
+            totals = asyncio.run(run_bot(questions, args.concurrency))
+        wall = time.perf_counter() - wall0
+        ru1 = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        if stub is not None:
+            stub.terminate()
+            stub.wait()
+
+    cpu = (ru1.ru_utime - ru0.ru_utime) + (ru1.ru_stime - ru0.ru_stime)
+    stages = {"total": percentiles(totals)}
+    for stage in STAGES[1:]:
+        stages[stage] = percentiles([r[stage] for r in collector.records if stage in r])
+    tps = [r["tokens_per_s"] for r in collector.records if "tokens_per_s" in r]
+    report = {
+        "mode":        args.mode,
+        "concurrency": args.concurrency,
+        "questions":   len(questions),
+        "wall_s":      round(wall, 2),
+        "qps":         round(len(questions) / wall, 3),
+        "cpu_percent": round(100 * cpu / wall, 1),
+        "max_rss_mb":  round(ru1.ru_maxrss / 1024, 1),   # Linux: ru_maxrss в КБ
+        "tokens_per_s": round(float(np.mean(tps)), 1) if tps else None,
+        "stages":      {k: v for k, v in stages.items() if v},
+    }
+
+    print(f"\nQPS {report['qps']}  wall {report['wall_s']}s  CPU {report['cpu_percent']}%  RSS {report['max_rss_mb']} MB")
+    print(f"{'stage':<10}{'p50':>9}{'p95':>9}{'p99':>9}{'n':>6}")
+    for stage, p in report["stages"].items():
+        print(f"{stage:<10}{p['p50']:>9.3f}{p['p95']:>9.3f}{p['p99']:>9.3f}{p['n']:>6}")
+
+    for path in (args.out, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare(report, json.load(f), args.tolerance)
+        if problems:
+            print("\nREGRESSIONS:")
+            for p in problems:
+                print("  " + p)
+            return 1
+        print("\nNo regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+# stub_ollama.py
+#
+# Заглушка Ollama для проверки src/model.py без настоящих моделей:
+#   python test/stub_ollama.py --port 11501 --tokens 40 --delay 0.02
+#   OLLAMA_URL=http://127.0.0.1:11501,http://127.0.0.1:11502 python src/telegram_bot.py
+#
+# Отвечает на /api/chat (NDJSON-стрим или один JSON), /api/generate (keep_alive=0 — выгрузка)
+# и /api/ps. --fail-rate имитирует 500 до первого токена; упавший сервер — просто порт без заглушки.
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+
+def make_app(tokens: int = 40, delay: float = 0.02, load_time: float = 0.0,
+             fail_rate: float = 0.0, models: list[str] | None = None) -> web.Application:
+    """
+    tokens — сколько токенов в ответе, delay — пауза между токенами (сек.),
+    load_time — задержка первого запроса к незагруженной модели.
+    """
+    loaded: dict[str, float] = {m: time.time() for m in (models or [])}
+    stats = {"requests": 0, "failed": 0, "inflight": 0, "max_inflight": 0}
+
+    async def chat(request: web.Request) -> web.StreamResponse:
+        body  = await request.json()
+        model = body.get("model", "")
+        stats["requests"] += 1
+        if random.random() < fail_rate:
+            stats["failed"] += 1
+            return web.json_response({"error": "stub failure"}, status=500)
+
+        stats["inflight"] += 1
+        stats["max_inflight"] = max(stats["max_inflight"], stats["inflight"])
+        t0 = time.monotonic()
+        try:
+            if model not in loaded:
+                await asyncio.sleep(load_time)
+                loaded[model] = time.time()
+            n = body.get("options", {}).get("num_predict") or tokens
+            n = min(n, tokens)
+            if not body.get("stream", True):
+                await asyncio.sleep(delay * n)
+                return web.json_response({
+                    "model": model, "done": True,
+                    "message": {"role": "assistant", "content": "tok " * n},
+                    "load_duration": int(load_time * 1e9),
+                })
+            resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+            await resp.prepare(request)
+            for _ in range(n):
+                await asyncio.sleep(delay)
+                line = {"model": model, "message": {"role": "assistant", "content": "tok "}, "done": False}
+                await resp.write(json.dumps(line).encode() + b"\n")
+            prompt_len = sum(len(m.get("content", "")) for m in body.get("messages", [])) // 4
+            await resp.write(json.dumps({
+                "model": model, "done": True,
+                "prompt_eval_count": prompt_len,
+                "eval_count":        n,
+                "eval_duration":     int(delay * n * 1e9),
+                "total_duration":    int((time.monotonic() - t0) * 1e9),
+            }).encode() + b"\n")
+            await resp.write_eof()
+            return resp
+        finally:
+            stats["inflight"] -= 1
+
+    async def generate(request: web.Request) -> web.Response:
+        body = await request.json()
+        if body.get("keep_alive") == 0:
+            loaded.pop(body.get("model", ""), None)
+        return web.json_response({"model": body.get("model", ""), "done": True, "response": ""})
+
+    async def ps(request: web.Request) -> web.Response:
+        return web.json_response({"models": [
+            {"name": m, "expires_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t + 1800))}
+            for m, t in loaded.items()
+        ]})
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post("/api/chat", chat)
+    app.router.add_post("/api/generate", generate)
+    app.router.add_get("/api/ps", ps)
+    app.router.add_get("/stats", get_stats)
+    app["stats"] = stats
+    return app
+
+async def serve(app: web.Application, port: int, host: str = "127.0.0.1") -> web.AppRunner:
+    """
+    Запуск внутри уже работающего event loop (для нагрузочных тестов).
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Stub Ollama server")
+    ap.add_argument("--port",      type=int,   default=11501)
+    ap.add_argument("--tokens",    type=int,   default=40)
+    ap.add_argument("--delay",     type=float, default=0.02)
+    ap.add_argument("--load-time", type=float, default=0.0)
+    ap.add_argument("--fail-rate", type=float, default=0.0)
+    ap.add_argument("--models",    nargs="*",  default=[])
+    args = ap.parse_args()
+
+    app = make_app(args.tokens, args.delay, args.load_time, args.fail_rate, args.models)
+    print(f"Stub Ollama on 127.0.0.1:{args.port}", file=sys.stderr)
+    web.run_app(app, host="127.0.0.1", port=args.port, print=None)